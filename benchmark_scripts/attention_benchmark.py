@@ -0,0 +1,75 @@
+import sys
+sys.path.append('../')
+
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+
+from models.transformer_custom import TransformerEncoderLayer
+
+# use argparse to get command line arguments for the benchmark
+parser = argparse.ArgumentParser()
+parser.add_argument('--seq_lens', type=int, nargs='+', default=[200, 400, 1000, 2000, 4000])
+parser.add_argument('--kernels', type=str, nargs='+', default=['softmax', 'elu', 'random'])
+parser.add_argument('--backends', type=str, nargs='+', default=['sdpa', 'einsum']) # only used by the softmax kernel
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--d_model', type=int, default=128)
+parser.add_argument('--nhead', type=int, default=8)
+parser.add_argument('--n_repeats', type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def run_layer(attention_kernel, seq_len, backend='sdpa'):
+    '''times forward+backward of one TNO encoder layer on a [0, 1] grid, returns (seconds per step, peak MB)'''
+    torch.manual_seed(0)
+    layer = TransformerEncoderLayer(d_model=args.d_model, nhead=args.nhead, dim_feedforward=args.d_model,
+                                    attention_kernel=attention_kernel).to(device)
+    if attention_kernel == 'softmax':
+        layer.self_attn.scaled_dot_product_attention.use_sdpa = backend == 'sdpa'
+    x = torch.randn(args.batch_size, seq_len, args.d_model, device=device)
+    coords = torch.linspace(0, 1, seq_len, device=device).reshape(-1, 1, 1)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # warm up, then time
+    layer(x, coords).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(args.n_repeats):
+        layer(x, coords).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    step_time = (time.perf_counter() - start) / args.n_repeats
+
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        # ru_maxrss is in kilobytes on linux
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) / 2**10
+    return step_time, peak_mb
+
+
+def run_in_subprocess(attention_kernel, seq_len, backend):
+    # a fresh process per configuration so that peak RSS is not shared between runs
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(run_layer, (attention_kernel, seq_len, backend))
+
+
+if __name__ == '__main__':
+    print(f'device: {device}, batch_size: {args.batch_size}, d_model: {args.d_model}, nhead: {args.nhead}')
+    print(f"{'kernel':>10} {'backend':>8} {'seq_len':>8} {'ms/step':>10} {'samples/s':>10} {'peak MB':>10}")
+    for seq_len in args.seq_lens:
+        for attention_kernel in args.kernels:
+            for backend in (args.backends if attention_kernel == 'softmax' else ['einsum']):
+                if device.type == 'cuda':
+                    step_time, peak_mb = run_layer(attention_kernel, seq_len, backend)
+                else:
+                    step_time, peak_mb = run_in_subprocess(attention_kernel, seq_len, backend)
+                print(f'{attention_kernel:>10} {backend:>8} {seq_len:>8} {1e3*step_time:>10.2f} {args.batch_size/step_time:>10.1f} {peak_mb:>10.1f}')
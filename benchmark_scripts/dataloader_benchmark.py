@@ -0,0 +1,76 @@
+import sys
+sys.path.append('../')
+
+import argparse
+import itertools
+import time
+import torch
+
+from datasets import MetaDataModule
+
+# use argparse to get command line arguments for the benchmark
+parser = argparse.ArgumentParser()
+parser.add_argument('--domain_dim', type=int, default=1) # 1 for the ODE datasets, 2 for the 2D spatial files
+parser.add_argument('--dyn_sys_name', type=str, default='Lorenz63')
+parser.add_argument('--n_trajectories', type=int, default=10000) # training size of the ODE datasets
+parser.add_argument('--T', type=float, default=2)
+parser.add_argument('--lazy_loading', action='store_true') # 2D files read on demand
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2, 4])
+parser.add_argument('--pin_memory', type=int, nargs='+', default=[0, 1])
+parser.add_argument('--persistent_workers', type=int, nargs='+', default=[0, 1])
+parser.add_argument('--prefetch_factor', type=int, nargs='+', default=[2])
+parser.add_argument('--shuffle', type=int, nargs='+', default=[1])
+parser.add_argument('--tensor_batching', type=int, nargs='+', default=[0, 1]) # whole batches sliced out of the in-memory data
+parser.add_argument('--n_epochs', type=int, default=3) # persistent workers only pay off from the second epoch
+args = parser.parse_args()
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def make_datamodule(**loader_kwargs):
+    if args.domain_dim == 1:
+        data_kwargs = {'size': {'train': args.n_trajectories, 'val': 1, 'test': 1},
+                       'T': {'train': args.T, 'val': args.T, 'test': args.T}}
+    else:
+        data_kwargs = {'lazy_loading': args.lazy_loading}
+    datamodule = MetaDataModule(domain_dim=args.domain_dim, dyn_sys_name=args.dyn_sys_name,
+                                batch_size=args.batch_size, **data_kwargs, **loader_kwargs)
+    datamodule.setup('fit')
+    return datamodule
+
+
+def time_epochs(datamodule):
+    '''returns training samples per second, including the copies to device, over n_epochs'''
+    n_samples = 0
+    start = time.perf_counter()
+    for _ in range(args.n_epochs):
+        # the same cached loader every epoch, as the trainer gets it
+        for x, y, coords_x, coords_y in datamodule.train_dataloader():
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            n_samples += x.shape[0]
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return n_samples / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    # the data is generated or read once, only the loader settings change between runs
+    datamodule = make_datamodule()
+    print(f'device: {device}, dataset: {args.dyn_sys_name}, train samples: {len(datamodule.train)}, batch_size: {args.batch_size}, epochs: {args.n_epochs}')
+    print(f"{'tensor':>7} {'workers':>8} {'pin':>4} {'persistent':>11} {'prefetch':>9} {'shuffle':>8} {'samples/s':>11}")
+    for tensor_batching, num_workers, pin_memory, persistent_workers, prefetch_factor, shuffle in itertools.product(
+            args.tensor_batching, args.num_workers, args.pin_memory, args.persistent_workers, args.prefetch_factor, args.shuffle):
+        if (num_workers == 0 or tensor_batching) and (persistent_workers or prefetch_factor != args.prefetch_factor[0]):
+            # worker settings do not apply without workers
+            continue
+        if tensor_batching and num_workers != args.num_workers[0]:
+            # tensor batches are always sliced in the main process
+            continue
+        datamodule.loader_kwargs = {'num_workers': num_workers, 'pin_memory': bool(pin_memory and device.type == 'cuda'),
+                                    'persistent_workers': bool(persistent_workers), 'prefetch_factor': prefetch_factor}
+        datamodule.shuffle = bool(shuffle)
+        datamodule.tensor_batching = bool(tensor_batching)
+        datamodule.reset_dataloaders()
+        samples_per_second = time_epochs(datamodule)
+        print(f'{tensor_batching:>7} {num_workers:>8} {pin_memory:>4} {persistent_workers:>11} {prefetch_factor:>9} {shuffle:>8} {samples_per_second:>11.1f}')
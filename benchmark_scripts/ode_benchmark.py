@@ -0,0 +1,70 @@
+import sys
+sys.path.append('../')
+
+import argparse
+import time
+import torch
+from torchdiffeq import odeint
+
+from datasets import load_dyn_sys_class
+
+# use argparse to get command line arguments for the benchmark
+parser = argparse.ArgumentParser()
+parser.add_argument('--systems', type=str, nargs='+', default=['Lorenz63', 'Rossler', 'ControlledODE'])
+parser.add_argument('--n_trajectories', type=int, default=10000)
+parser.add_argument('--T', type=float, default=2)
+parser.add_argument('--dt', type=float, default=0.01)
+parser.add_argument('--step_sizes', type=float, nargs='+', default=[1e-3, 2.5e-3, 5e-3]) # steps of the fixed-step solvers
+parser.add_argument('--n_reference', type=int, default=200) # trajectories compared with a tight-tolerance solve
+parser.add_argument('--n_repeats', type=int, default=1)
+args = parser.parse_args()
+
+
+def make_system(name, size, method='dopri5', step_size=2.5e-3):
+    # the same seed for every solver, so that all of them integrate the same initial conditions
+    torch.manual_seed(0)
+    return load_dyn_sys_class(name)(params={'size': size, 'method': method, 'step_size': step_size})
+
+
+def time_solve(name, method, step_size=2.5e-3):
+    '''returns (seconds per solve of n_trajectories, solution of the first n_reference trajectories)'''
+    dynsys = make_system(name, args.n_trajectories, method, step_size)
+    if method == 'torchdiffeq_rk4':
+        # torchdiffeq's own fixed-step rk4, for reference
+        times = torch.arange(0, args.T, args.dt)
+        solve = lambda: odeint(dynsys.rhs, dynsys.get_inits(args.n_trajectories), times, method='rk4',
+                               options={'step_size': step_size})
+    else:
+        solve = lambda: dynsys.solve(args.n_trajectories, args.T, args.dt)[0]
+
+    start = time.perf_counter()
+    for _ in range(args.n_repeats):
+        torch.manual_seed(1)
+        xyz = solve()
+    return (time.perf_counter() - start) / args.n_repeats, xyz[:, :args.n_reference]
+
+
+def reference_solution(name):
+    # tight tolerance double precision dopri5 on the same initial conditions
+    dynsys = make_system(name, args.n_trajectories)
+    torch.manual_seed(1)
+    x0 = dynsys.get_inits(args.n_trajectories)[:args.n_reference].double()
+    # ControlledODE draws one control per trajectory
+    for attr in ['xi', 'freqs', 'decay']:
+        if hasattr(dynsys, attr):
+            setattr(dynsys, attr, getattr(dynsys, attr)[:args.n_reference].double())
+    times = torch.arange(0, args.T, args.dt).double()
+    return odeint(dynsys.rhs, x0, times, rtol=1e-10, atol=1e-10)
+
+
+if __name__ == '__main__':
+    print(f'threads: {torch.get_num_threads()}, n_trajectories: {args.n_trajectories}, T: {args.T}, dt: {args.dt}')
+    print(f"{'system':>14} {'solver':>16} {'step':>8} {'s/solve':>9} {'traj/s':>10} {'max err':>10}")
+    for name in args.systems:
+        reference = reference_solution(name)
+        runs = [('dopri5', None)] + [(method, h) for h in args.step_sizes for method in ['rk4', 'torchdiffeq_rk4']]
+        for method, step_size in runs:
+            seconds, xyz = time_solve(name, method, step_size or 2.5e-3)
+            error = (xyz.double() - reference).abs().max().item()
+            step = '-' if step_size is None else f'{step_size:g}'
+            print(f'{name:>14} {method:>16} {step:>8} {seconds:>9.3f} {args.n_trajectories/seconds:>10.1f} {error:>10.2e}')
@@ -0,0 +1,94 @@
+import sys
+sys.path.append('../')
+
+import argparse
+import time
+import torch
+
+from models.transformer_custom import spectral_mul
+from models.transformer_custom import stack_spectral_weights
+
+# use argparse to get command line arguments for the benchmark
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=16)
+parser.add_argument('--num_patches', type=int, default=16) # used by the ViTNO and FANO layers
+parser.add_argument('--d_model', type=int, default=64)
+parser.add_argument('--nhead', type=int, default=8)
+parser.add_argument('--modes', type=int, nargs='+', default=[9, 12, 16])
+parser.add_argument('--grid_size', type=int, default=64) # rows and columns of the transformed grid (or patch)
+parser.add_argument('--n_repeats', type=int, default=20)
+args = parser.parse_args()
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def separate_bands(x_low, x_high, weights1, weights2, equation):
+    # the previous layout, one complex einsum per frequency band
+    return torch.einsum(equation, x_low, weights1), torch.einsum(equation, x_high, weights2)
+
+
+def stacked_bands(x_low, x_high, weights):
+    # both bands in one batched matrix multiply, batch and patch dimensions flattened together
+    return spectral_mul(x_low.flatten(0, -4), x_high.flatten(0, -4), weights)
+
+
+def time_step(fn, inputs):
+    '''times forward+backward of fn, returns milliseconds per step'''
+    outputs = fn()
+    outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+    grad_outputs = [torch.randn_like(out) for out in outputs]
+
+    def step():
+        # backpropagate fixed upstream gradients so only the contraction itself is timed
+        outputs = fn()
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        torch.autograd.backward(outputs, grad_outputs)
+        for tensor in inputs:
+            tensor.grad = None
+
+    # warm up, then time
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(args.n_repeats):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return 1e3 * (time.perf_counter() - start) / args.n_repeats
+
+
+def run_layer(layer, modes):
+    '''returns (separate, stacked) milliseconds per step for the contraction of one spectral layer'''
+    torch.manual_seed(0)
+    d_k = args.d_model // args.nhead
+    # (x_ft band shape, weight shape, einsum of the previous layout) for each spectral class
+    shapes = {'SpectralConv2d': ((args.batch_size, args.d_model, modes, modes),
+                                 (args.d_model, args.d_model, modes, modes),
+                                 "bixy,ioxy->boxy"),
+              'SpectralConv2d_in': ((args.batch_size, args.num_patches, 3, modes, modes),
+                                    (3, args.d_model, modes, modes),
+                                    "bnixy,ioxy->bnoxy"),
+              'SpectralConv2d_Attention': ((args.batch_size, args.num_patches, args.d_model, modes, modes),
+                                           (args.d_model, d_k, modes, modes, args.nhead),
+                                           "bnixy,ioxyh->bnoxyh")}
+    x_shape, weight_shape, equation = shapes[layer]
+
+    # the layers slice both bands out of the full rfft2 spectrum
+    x_ft = torch.randn(*x_shape[:-2], args.grid_size, args.grid_size//2 + 1, dtype=torch.cfloat, device=device)
+    x_low, x_high = x_ft[..., :modes, :modes], x_ft[..., -modes:, :modes]
+    weights1, weights2 = [torch.randn(weight_shape, dtype=torch.cfloat, device=device).requires_grad_() for _ in range(2)]
+    weights = stack_spectral_weights(weights1.detach(), weights2.detach()).requires_grad_()
+
+    separate = time_step(lambda: separate_bands(x_low, x_high, weights1, weights2, equation), [weights1, weights2])
+    stacked = time_step(lambda: stacked_bands(x_low, x_high, weights), [weights])
+    return separate, stacked
+
+
+if __name__ == '__main__':
+    print(f'device: {device}, batch_size: {args.batch_size}, num_patches: {args.num_patches}, d_model: {args.d_model}, nhead: {args.nhead}')
+    print(f"{'layer':>25} {'modes':>6} {'separate ms':>12} {'stacked ms':>11} {'speedup':>8}")
+    for layer in ['SpectralConv2d', 'SpectralConv2d_in', 'SpectralConv2d_Attention']:
+        for modes in args.modes:
+            separate, stacked = run_layer(layer, modes)
+            print(f'{layer:>25} {modes:>6} {separate:>12.2f} {stacked:>11.2f} {separate/stacked:>8.2f}')
@@ -0,0 +1,50 @@
+import torch
+import wandb
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.loggers import WandbLogger
+
+
+class NormMonitor(Callback):
+    '''
+    Logs the norms of the gradients and of the parameters before the optimizer step, every log_every_n_steps optimizer
+    steps. With gradient accumulation, the gradients are those accumulated over all the micro-batches of the step.
+
+    The norms of all tensors are computed by one fused torch._foreach_norm and copied to the host at once. Each group
+    is logged as its total norm and, with a WandbLogger, a histogram of the per-tensor norms, instead of one scalar
+    per parameter.
+
+    Args:
+        log_every_n_steps (int): Optimizer steps between two logs, positive.
+        norm_type (float): Order of the norms.
+    '''
+    def __init__(self, log_every_n_steps=50, norm_type=2.0):
+        super().__init__()
+        # the runners disable the callback with None, rather than constructing it with a non-positive interval
+        if log_every_n_steps is None or log_every_n_steps <= 0:
+            raise ValueError(f"log_every_n_steps must be a positive integer, got {log_every_n_steps}")
+        self.log_every_n_steps = log_every_n_steps
+        self.norm_type = norm_type
+
+    def should_log(self, trainer):
+        return trainer.global_step % self.log_every_n_steps == 0
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer):
+        # once per optimizer step, after accumulation. If using mixed precision, the gradients are already unscaled here
+        if self.should_log(trainer):
+            grads = [param.grad for param in pl_module.parameters() if param.grad is not None]
+            self.log_norms(trainer, pl_module, 'grad_norm/beforeOptimizer', grads)
+            self.log_norms(trainer, pl_module, 'param_norm/beforeOptimizer', list(pl_module.parameters()))
+
+    @torch.no_grad()
+    def log_norms(self, trainer, pl_module, tag, tensors):
+        if not tensors:
+            return
+        # norms of complex tensors are real, all are stacked as float32 for a single copy to the host
+        norms = torch.stack([norm.float() for norm in torch._foreach_norm(tensors, self.norm_type)]).cpu()
+        total = torch.linalg.vector_norm(norms, self.norm_type).item()
+        # straight to the loggers, self.log would repeat the value at every step until the next log
+        for logger in trainer.loggers:
+            metrics = {f'{tag}/total': total}
+            if isinstance(logger, WandbLogger):
+                metrics[f'{tag}/histogram'] = wandb.Histogram(norms.numpy())
+            logger.log_metrics(metrics, step=trainer.global_step)
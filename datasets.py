@@ -1,10 +1,19 @@
+import os
+import copy
+import math
+import json
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from torchdiffeq import odeint
 import pytorch_lightning as pl
 from utils import UnitGaussianNormalizer
-from utils import subsample_and_flatten, patch_coords
+from utils import subsample_and_flatten, subsample_indices, patch_coords
 import h5py
 
 def MetaDataModule(domain_dim=1, **kwargs):
@@ -73,7 +82,46 @@ def load_dyn_sys_class(dataset_name):
     else:
         raise ValueError(f"Dataset class '{dataset_name}' not found.")
 
+def rk4_solve(rhs_into, x0, times, step_size):
+    '''
+    Classical fixed-step Runge-Kutta 4 for a batch of trajectories. Every trajectory takes the same steps, so there is
+    no per-step error norm over the batch, and the stages are evaluated into preallocated buffers.
+
+    Args:
+        rhs_into (callable): rhs_into(t, x, out) writes the derivative at (t, x) into out and returns it.
+        x0 (torch.Tensor): Initial conditions of shape (batch_size, state_dim).
+        times (torch.Tensor): Increasing output times of shape (Seq_len,), starting at the initial time.
+        step_size (float): Largest step, each output interval is split into equal steps no longer than this.
+
+    Returns:
+        torch.Tensor: The solution at times, of shape (Seq_len, batch_size, state_dim).
+    '''
+    xyz = x0.new_empty(len(times), *x0.shape)
+    xyz[0] = x0
+    x = x0.clone()
+    k1, k2, k3, k4, stage = [torch.empty_like(x0) for _ in range(5)]
+    times = times.tolist()
+    for i in range(len(times) - 1):
+        n_steps = max(1, math.ceil((times[i+1] - times[i]) / step_size - 1e-9))
+        h = (times[i+1] - times[i]) / n_steps
+        for j in range(n_steps):
+            t = times[i] + j*h
+            rhs_into(t, x, k1)
+            rhs_into(t + h/2, torch.add(x, k1, alpha=h/2, out=stage), k2)
+            rhs_into(t + h/2, torch.add(x, k2, alpha=h/2, out=stage), k3)
+            rhs_into(t + h, torch.add(x, k3, alpha=h, out=stage), k4)
+            # x += h/6 * (k1 + 2*k2 + 2*k3 + k4)
+            x.add_(k2.add_(k3).mul_(2).add_(k1).add_(k4), alpha=h/6)
+        xyz[i+1] = x
+    return xyz
+
+
 class DynSys(object):
+    # ODE solver: 'dopri5' (adaptive, torchdiffeq) or 'rk4' (fixed step, see rk4_solve), subclasses may override
+    method = 'dopri5'
+    # largest step of the fixed-step solver
+    step_size = 2.5e-3
+
     def __init__(self, state_dim=1, size=1):
         '''
         Initialize a dynamical system object.
@@ -83,7 +131,18 @@ class DynSys(object):
         '''
         self.state_dim = state_dim
         self.size = size
-    
+
+    def set_solver(self, params):
+        '''
+        Select the ODE solver from the optional 'method' and 'step_size' entries of params.
+
+        Args:
+            params (dict or None): Parameters of the dynamical system.
+        '''
+        params = params or {}
+        self.method = params.get('method', self.method)
+        self.step_size = params.get('step_size', self.step_size)
+
     def rhs(self, t, x):
         '''
         Right-hand side function of the dynamical system.
@@ -96,6 +155,21 @@ class DynSys(object):
             torch.Tensor: Derivative of the state vector.
         '''
         raise NotImplementedError
+
+    def rhs_into(self, t, x, out):
+        '''
+        Right-hand side function of the dynamical system, written into out. Used by the fixed-step solver, subclasses
+        override it to avoid allocating the derivative.
+
+        Args:
+            t (float): Time.
+            x (torch.Tensor): State vector.
+            out (torch.Tensor): Tensor of the shape of x that receives the derivative.
+
+        Returns:
+            torch.Tensor: out.
+        '''
+        return out.copy_(self.rhs(t, x))
     
     def get_inits(self, size):
         '''
@@ -109,7 +183,7 @@ class DynSys(object):
         '''
         raise NotImplementedError
 
-    def solve(self, N_traj, T, dt, test=False):
+    def solve(self, N_traj, T, dt, test=False, times=None):
         '''
         Solve the dynamical system using an ODE solver.
 
@@ -117,11 +191,12 @@ class DynSys(object):
             N_traj (int): Number of trajectories to solve.
             T (float): Total time.
             dt (float): Time step.
+            times (torch.Tensor): Increasing output times, used instead of the uniform grid with step dt if given.
 
         Returns:
             tuple: A tuple containing the trajectories and the corresponding time points.
         '''
-        times = torch.arange(0, T, dt)
+        times = torch.arange(0, T, dt) if times is None else times
         '''
         #uncomment to experiment with non uniformly sampled time series
         if test==True:
@@ -138,7 +213,10 @@ class DynSys(object):
             #times = (sorted_vector - sorted_vector.min()) / (sorted_vector.max() - sorted_vector.min()) * T
             ####
         xyz0 = self.get_inits(N_traj)
-        xyz = odeint(self.rhs, xyz0, times)
+        if self.method == 'rk4':
+            xyz = rk4_solve(self.rhs_into, xyz0, times, self.step_size)
+        else:
+            xyz = odeint(self.rhs, xyz0, times, method=self.method)
         # Size, Seq_len, batch_size, input_dim
         return xyz, times
 
@@ -212,12 +290,36 @@ class ControlledODE(DynSys):
         self.xi = torch.randn(self.size, 10)
         self.freqs = torch.empty(self.size, 10).uniform_(0, 10)
         self.decay = (1/torch.linspace(1, 10, steps=10)).reshape(1,-1).repeat(self.size,1)
+        # trajectories per chunk when evaluating the control on a time grid, see ut
+        self.control_chunk_size = params.get('control_chunk_size')
+        self.set_solver(params)
 
     def u(self, t, x):
         return torch.sum(self.xi * self.decay* torch.sin(np.pi * self.freqs * t),dim=1).reshape(-1,1)
     
-    def ut(self,t,x):
-        return torch.sum(self.xi.unsqueeze(-1).repeat(1,1,t.shape[-1]) * self.decay.unsqueeze(-1).repeat(1,1,t.shape[-1])* torch.sin(np.pi * self.freqs.unsqueeze(-1).repeat(1,1,t.shape[-1]) * t),dim=1)
+    def ut(self, t, x=None, chunk_size=None):
+        '''
+        Evaluate the control u of every trajectory on a time grid.
+
+        The (size, 10, Seq_len) factors are broadcast rather than repeated, and the trajectories are processed in chunks
+        whose (chunk_size, 10, Seq_len) temporary is no larger than the output, so peak memory is O(size*Seq_len).
+
+        Args:
+            t (torch.Tensor): Times of shape (Seq_len,).
+            x (torch.Tensor): The state, unused.
+            chunk_size (int): Trajectories per chunk, defaults to params['control_chunk_size'] or a tenth of size.
+
+        Returns:
+            torch.Tensor: The control of shape (size, Seq_len).
+        '''
+        size = self.xi.shape[0]
+        chunk_size = chunk_size or self.control_chunk_size or max(1, math.ceil(size / 10))
+        u = self.xi.new_empty(size, t.shape[-1])
+        for start in range(0, size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            torch.sum(self.xi[chunk].unsqueeze(-1) * self.decay[chunk].unsqueeze(-1) * torch.sin(np.pi * self.freqs[chunk].unsqueeze(-1) * t),
+                      dim=1, out=u[chunk])
+        return u
 
     def du(self, t, x):
         return torch.sum(np.pi * self.xi * self.freqs * self.decay* torch.cos(np.pi * self.freqs * t),dim=1).reshape(-1,1)
@@ -236,10 +338,11 @@ class ControlledODE(DynSys):
             torch.Tensor: The derivative of the state vector.
 
         '''
-        v = x[:, 0:1]
-        dv = torch.sin(v) * self.du(t, x)
+        return self.rhs_into(t, x, torch.empty_like(x[:, 0:1]))
 
-        return dv
+    def rhs_into(self, t, x, out):
+        v = x[:, 0:1]
+        return torch.mul(torch.sin(v), self.du(t, x), out=out)
 
     def get_inits(self, size):
         '''
@@ -272,6 +375,7 @@ class Lorenz63(DynSys):
         self.sigma = sigma
         self.rho = rho
         self.beta = beta
+        self.set_solver(params)
 
     def rhs(self, t, x):
         """
@@ -284,11 +388,15 @@ class Lorenz63(DynSys):
         Returns:
             torch.Tensor: The derivative of the state tensor.
         """
-        x, y, z = x[:, 0:1], x[:, 1:2], x[:, 2:3]
-        dx = self.sigma * (y - x)
-        dy = x * (self.rho - z) - y
-        dz = x * y - self.beta * z
-        return torch.cat([dx, dy, dz], dim=1)
+        return self.rhs_into(t, x, torch.empty_like(x))
+
+    def rhs_into(self, t, x, out):
+        # each derivative is written into its column of out, instead of concatenating three new columns
+        x, y, z = x[:, 0], x[:, 1], x[:, 2]
+        torch.mul(y - x, self.sigma, out=out[:, 0])
+        torch.sub(x * (self.rho - z), y, out=out[:, 1])
+        torch.sub(x * y, self.beta * z, out=out[:, 2])
+        return out
 
     def get_inits(self, size):
         """
@@ -321,6 +429,7 @@ class Rossler(DynSys):
         self.a = a
         self.b = b
         self.c = c
+        self.set_solver(params)
 
     def rhs(self, t, x):
         """
@@ -333,11 +442,14 @@ class Rossler(DynSys):
         Returns:
             torch.Tensor: The derivative of the state tensor.
         """
-        x, y, z = x[:, 0:1], x[:, 1:2], x[:, 2:3]
-        dx = -y - z
-        dy = x + self.a * y
-        dz = self.b + z * (x - self.c)
-        return torch.cat([dx, dy, dz], dim=1)
+        return self.rhs_into(t, x, torch.empty_like(x))
+
+    def rhs_into(self, t, x, out):
+        x, y, z = x[:, 0], x[:, 1], x[:, 2]
+        torch.sub(-y, z, out=out[:, 0])
+        torch.add(x, self.a * y, out=out[:, 1])
+        torch.add(z * (x - self.c), self.b, out=out[:, 2])
+        return out
 
     def get_inits(self, size):
         """
@@ -355,10 +467,296 @@ class Rossler(DynSys):
         xz0 = torch.cat([x0, y0, z0], dim=1)
         return xz0
 
+def solve_trajectories(dynsys, dyn_sys_name, size, T, dt, test=False):
+    '''
+    Solve trajectories of a dynamical system, drawing initial conditions from the global torch RNG.
+
+    Args:
+        dynsys (DynSys): The dynamical system, constructed for size trajectories.
+        dyn_sys_name (str): The name of the dynamical system.
+        size (int): Number of trajectories.
+        T (float): Total time.
+        dt (float or list): Time step, or a list of time steps that are solved together on the union of their grids.
+        test (bool): Whether the trajectories are used as a test set.
+
+    Returns:
+        tuple: The trajectories of shape (size, Seq_len, state_dim), the times of shape (Seq_len,) and, for
+               ControlledODE, the control of shape (size, Seq_len, 1) (None for the other systems).
+    '''
+    times = multirate_times(T, dt) if isinstance(dt, (list, tuple)) else None
+    # Seq_len, Size (N_traj), state_dim
+    xyz, times = dynsys.solve(N_traj=size, T=T, dt=dt, test=test, times=times)
+    control = None
+    if dyn_sys_name == 'ControlledODE':
+        control = dynsys.ut(times, xyz.permute(1, 0, 2)).unsqueeze(-1)
+    return xyz.permute(1, 0, 2), times, control
+
+
+def multirate_times(T, sample_rates):
+    '''union of the uniform time grids of several sample rates, each grid is contained exactly'''
+    return torch.unique(torch.cat([torch.arange(0, T, dt) for dt in sample_rates]))
+
+
+def split_multirate(xyz, times, control, T, sample_rates):
+    '''
+    Split trajectories solved on multirate_times(T, sample_rates) into one set of trajectories per sample rate.
+
+    Args:
+        xyz, times, control: Trajectories as returned by solve_trajectories for the list sample_rates.
+        T (float): Total time.
+        sample_rates (list): Time steps.
+
+    Returns:
+        dict: (xyz, times, control) on the grid of each sample rate, keyed by the sample rate.
+    '''
+    split = {}
+    for dt in sample_rates:
+        # the union grid contains every grid value exactly, so this is an exact lookup
+        idx = torch.searchsorted(times, torch.arange(0, T, dt))
+        split[dt] = (xyz[:, idx], times[idx], None if control is None else control[:, idx])
+    return split
+
+
+def solve_trajectory_chunk(dyn_sys_name, params, size, T, dt, test, seed):
+    '''
+    Solve one chunk of a cached dataset from its own seed, so that the result does not depend on which process
+    solves it. Returns numpy arrays, so that chunks are cheap to send back from worker processes.
+    '''
+    # a private RNG stream, so solving in the main process leaves the global one untouched
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(seed)
+        dynsys = load_dyn_sys_class(dyn_sys_name)(params=dict(params, size=size))
+        xyz, times, control = solve_trajectories(dynsys, dyn_sys_name, size, T, dt, test=test)
+    return xyz.numpy(), times.numpy(), None if control is None else control.numpy()
+
+
+def trajectory_cache_key(spec):
+    '''content address of a dataset: sha1 of its json-encoded generation settings'''
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_trajectories(dynsys, dyn_sys_name, params, size, T, dt, test=False,
+                      cache_dir=None, seed=0, split='train', num_workers=1, chunk_size=1000):
+    '''
+    Solved trajectories, from the on-disk cache if cache_dir is set, otherwise from dynsys and the global torch RNG.
+    Arguments are as in solve_trajectories and load_or_solve_trajectories, returns are as in solve_trajectories.
+    '''
+    if cache_dir is None:
+        return solve_trajectories(dynsys, dyn_sys_name, size, T, dt, test=test)
+    # the cache stores full trajectories, so that runs which only differ in input/output inds share an entry
+    spec = {'dyn_sys_name': dyn_sys_name, 'params': {k: v for k, v in params.items() if k != 'size'},
+            'size': size, 'T': T, 'dt': dt, 'test': test, 'seed': seed, 'split': split, 'chunk_size': chunk_size}
+    return load_or_solve_trajectories(cache_dir, spec, num_workers=num_workers)
+
+
+def load_or_solve_trajectories(cache_dir, spec, num_workers=1):
+    '''
+    Load solved trajectories from the on-disk cache, solving and storing them on a miss.
+
+    The trajectories are split into chunks of spec['chunk_size'] that are seeded from the cache key, so a given spec
+    always produces the same data, whatever the number of workers. Arrays are stored as .npy files and memory-mapped
+    copy-on-write when loaded, so a cache hit only reads the pages that are used.
+
+    Args:
+        cache_dir (str): Directory of the cache, one subdirectory per dataset.
+        spec (dict): Generation settings: dyn_sys_name, params, size, T, dt, test, seed, split and chunk_size.
+        num_workers (int): Number of processes solving chunks on a cache miss.
+
+    Returns:
+        tuple: The trajectories, times and control (or None) as in solve_trajectories.
+    '''
+    key = trajectory_cache_key(spec)
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        chunk_sizes = [min(spec['chunk_size'], spec['size'] - start) for start in range(0, spec['size'], spec['chunk_size'])]
+        # chunk seeds are derived from the content address, so different splits and settings get different data
+        args = [(spec['dyn_sys_name'], spec['params'], chunk_size, spec['T'], spec['dt'], spec['test'], int(key[:12], 16) + i)
+                for i, chunk_size in enumerate(chunk_sizes)]
+        if num_workers > 1 and len(args) > 1:
+            # fork, so that scripts without a __main__ guard are not re-run by the workers
+            # one thread per worker, the parallelism comes from the process pool
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=torch.set_num_threads, initargs=(1,)) as pool:
+                chunks = list(pool.map(solve_trajectory_chunk, *zip(*args)))
+        else:
+            chunks = [solve_trajectory_chunk(*a) for a in args]
+
+        arrays = {'xyz': np.concatenate([chunk[0] for chunk in chunks]), 'times': chunks[0][1]}
+        if chunks[0][2] is not None:
+            arrays['control'] = np.concatenate([chunk[2] for chunk in chunks])
+
+        # write to a private directory and rename it into place, so concurrent jobs never see a partial entry
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        with open(os.path.join(tmp_path, 'spec.json'), 'w') as f:
+            json.dump(spec, f, sort_keys=True, default=str)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another job stored the same dataset first
+            shutil.rmtree(tmp_path)
+
+    def load(name):
+        fname = os.path.join(path, name + '.npy')
+        return torch.from_numpy(np.load(fname, mmap_mode='c')) if os.path.exists(fname) else None
+    return load('xyz'), load('times'), load('control')
+
+
+def batch_shared(tensor):
+    '''whether tensor is a view expanded along the batch dimension, as the coordinates from shared_coords_collate'''
+    return isinstance(tensor, torch.Tensor) and tensor.dim() > 0 and tensor.stride(0) == 0
+
+
+class SharedCoordsBatch(tuple):
+    '''
+    The (x, y, coords_x, coords_y) batch of shared_coords_collate. DataLoader(pin_memory=True) pins custom batch types
+    with their pin_memory method: the shared coordinates are pinned once and expanded again, since pinning the expanded
+    view itself fails.
+    '''
+    def pin_memory(self):
+        return SharedCoordsBatch(t[:1].pin_memory().expand(t.shape) if batch_shared(t) else t.pin_memory() for t in self)
+
+
+def shared_coords_collate(batch):
+    '''
+    Collates (x, y, coords_x, coords_y) samples. Coordinates that are the same object in every sample, as the datasets
+    below return them, are copied once and expanded to the batch as a view with stride 0 along the batch dimension,
+    instead of being stacked into batch_size copies. Indexing coords[i] works as before.
+    '''
+    x, y = default_collate([sample[:2] for sample in batch])
+    coords = []
+    for k in (2, 3):
+        first = batch[0][k]
+        if all(sample[k] is first for sample in batch):
+            # copy once, so that in-place changes of the batch never reach the dataset
+            shared = torch.as_tensor(first).clone()
+            coords.append(shared.unsqueeze(0).expand(len(batch), *shared.shape))
+        else:
+            coords.append(default_collate([sample[k] for sample in batch]))
+    return SharedCoordsBatch((x, y, coords[0], coords[1]))
+
+
+def transfer_shared_coords(batch, device, transfer):
+    '''
+    Moves a batch to device with transfer(batch, device). Tensors shared by the batch (see batch_shared) are moved
+    once and expanded again on the device.
+    '''
+    shared = [batch_shared(t) for t in batch]
+    moved = transfer([t[:1] if s else t for t, s in zip(batch, shared)], device)
+    return [m.expand(t.shape) if s else m for m, t, s in zip(moved, batch, shared)]
+
+
+def make_dataloader(dataset, batch_size, shuffle=False, num_workers=0, pin_memory=False, persistent_workers=False,
+                    prefetch_factor=None):
+    '''
+    DataLoader of (x, y, coords_x, coords_y) samples, collated with shared_coords_collate.
+
+    Args:
+        dataset (Dataset): The dataset.
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to reshuffle the samples every epoch.
+        num_workers (int): Number of worker processes loading batches, 0 to load them in the main process.
+        pin_memory (bool): Whether to copy batches into page-locked memory, for faster and asynchronous copies to GPU.
+        persistent_workers (bool): Whether to keep the workers alive between epochs, only used with workers.
+        prefetch_factor (int): Batches loaded in advance by each worker, only used with workers (None for the default).
+
+    Returns:
+        torch.utils.data.DataLoader: The dataloader.
+    '''
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor}
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=pin_memory,
+                      collate_fn=shared_coords_collate, **worker_kwargs)
+
+
+def shutdown_workers(loader):
+    '''stops the worker processes that a DataLoader with persistent_workers keeps alive between epochs'''
+    iterator = getattr(loader, '_iterator', None)
+    if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+        iterator._shutdown_workers()
+    loader._iterator = None
+
+
+class TensorBatches(Dataset):
+    '''
+    Whole batches of an in-memory dataset of (x, y, coords_x, coords_y) samples, indexed by the slices or index tensors
+    of TensorBatchSampler. x and y are sliced or gathered directly out of the resident tensors, without a __getitem__
+    call per sample, and the coordinates shared by all samples are expanded to the batch as in shared_coords_collate.
+
+    Args:
+        dataset (Dataset): DynamicsDataset or in-memory Spatial2dDataset.
+        device (torch.device): Device where the whole dataset is kept, None to keep it where it is.
+    '''
+    def __init__(self, dataset, device=None):
+        self.x = torch.as_tensor(dataset.x).to(device)
+        self.y = torch.as_tensor(dataset.y).to(device)
+        # copied once, so that in-place changes of a batch never reach the dataset
+        self.coords = [torch.as_tensor(c).clone().to(device) for c in dataset[0][2:]]
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, indices):
+        x, y = self.x[indices], self.y[indices]
+        coords_x, coords_y = [c.unsqueeze(0).expand(x.shape[0], *c.shape) for c in self.coords]
+        return SharedCoordsBatch((x, y, coords_x, coords_y))
+
+
+class TensorBatchSampler(object):
+    '''
+    Batches of the indices of TensorBatches: slices in order, so batches are views of the resident tensors, or index
+    tensors of a new random permutation every epoch.
+    '''
+    def __init__(self, size, batch_size, shuffle=False):
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(self.size / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.size)
+            for start in range(0, self.size, self.batch_size):
+                yield order[start:start+self.batch_size]
+        else:
+            for start in range(0, self.size, self.batch_size):
+                yield slice(start, start + self.batch_size)
+
+
+def whole_batch(batch):
+    # TensorBatches already returns whole batches
+    return batch
+
+
+def make_tensor_dataloader(batches, batch_size, shuffle=False, pin_memory=False):
+    '''
+    DataLoader of TensorBatches. Batches are loaded in the main process, since slicing them is cheaper than sending
+    them from worker processes.
+
+    Args:
+        batches (TensorBatches): The batches.
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to reshuffle the samples every epoch.
+        pin_memory (bool): Whether to copy batches into page-locked memory, only used if the data is on the CPU.
+
+    Returns:
+        torch.utils.data.DataLoader: The dataloader.
+    '''
+    return DataLoader(batches, sampler=TensorBatchSampler(len(batches), batch_size, shuffle), batch_size=None,
+                      collate_fn=whole_batch, pin_memory=pin_memory and batches.x.device.type == 'cpu')
+
+
 class DynamicsDataset(Dataset):
     def __init__(self, size=1000, T=1, sample_rate=0.01, params={},
                  dyn_sys_name='Lorenz63',
                  input_inds=[1], output_inds=[-1], test=False,
+                 cache_dir=None, seed=0, split='train', num_workers=1, chunk_size=1000,
+                 trajectories=None,
                  **kwargs):
         """
         Initialize a DynamicsDataset object.
@@ -371,17 +769,31 @@ class DynamicsDataset(Dataset):
             dyn_sys_name (str): The name of the dynamical system.
             input_inds (list): The indices of the input components.
             output_inds (list): The indices of the output components.
+            cache_dir (str): Directory of the on-disk trajectory cache, None to solve with the global RNG every time.
+            seed (int): Seed of the cached trajectories.
+            split (str): Name of the split, part of the cache key so that splits get different trajectories.
+            num_workers (int): Number of processes solving trajectories on a cache miss.
+            chunk_size (int): Number of trajectories per seeded chunk on a cache miss.
+            trajectories (tuple): Already solved (xyz, times, control) as returned by solve_trajectories, used
+                                  instead of solving.
             **kwargs: Additional keyword arguments.
         """
         self.size = size
         self.T = T
         self.sample_rate = sample_rate
         params['size'] = size
+        self.dynsys_params = params
         self.dynsys = load_dyn_sys_class(dyn_sys_name)(params=params)
         self.dynsys_name = dyn_sys_name
         self.input_inds = input_inds
         self.output_inds = output_inds
         self.test = test
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.split = split
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.trajectories = trajectories
 
         self.generate_data()
 
@@ -389,29 +801,29 @@ class DynamicsDataset(Dataset):
         """
         Generate the input and output data for the dataset.
         """
-        # Seq_len, Size (N_traj), state_dim
-        xyz, times = self.dynsys.solve(N_traj=self.size, T=self.T, dt=self.sample_rate, test=self.test)
-
+        if self.trajectories is None:
+            xyz, times, control = load_trajectories(self.dynsys, self.dynsys_name, self.dynsys_params, self.size, self.T,
+                                                    self.sample_rate, test=self.test, cache_dir=self.cache_dir,
+                                                    seed=self.seed, split=self.split, num_workers=self.num_workers,
+                                                    chunk_size=self.chunk_size)
+        else:
+            xyz, times, control = self.trajectories
+            # only needed to build the dataset
+            self.trajectories = None
 
         if self.dynsys_name == 'ControlledODE':
-            self.x = self.dynsys.ut(times.reshape(1,1,-1).repeat(self.size,10,1), xyz.permute(1, 0, 2)).unsqueeze(-1)
-            self.y = xyz[:, :, :].permute(1, 0, 2)
+            self.x = control
+            self.y = xyz
 
         else:
 
             # use traj from the 1st component of L63 as input
-            self.x = xyz[:, :, self.input_inds].permute(1, 0, 2)
+            self.x = xyz[:, :, self.input_inds]
             # use traj from the 3rd component of L63 as output
-            self.y = xyz[:, :, self.output_inds].permute(1, 0, 2)
+            self.y = xyz[:, :, self.output_inds]
             # self.x, self.y are both: (n_traj (size), Seq_len, dim_state)
 
-        #normalize data
-        self.x_normalizer = UnitGaussianNormalizer(
-            self.x.reshape(-1, self.x.shape[-1]).data.numpy())
-        self.y_normalizer = UnitGaussianNormalizer(
-            self.y.reshape(-1, self.y.shape[-1]).data.numpy())
-        self.x = self.x_normalizer.encode(self.x)
-        self.y = self.y_normalizer.encode(self.y)
+        # the data is stored unnormalized, the LightningModule normalizes batches on device (see fit_normalizers)
 
         # currently, times are the same for input and output trajectories
         # and the same across all examples
@@ -442,6 +854,17 @@ class DynamicsDataset(Dataset):
         '''
         return self.x[idx], self.y[idx], self.times_x, self.times_y
 
+    def fit_normalizers(self):
+        '''
+        Fit unit Gaussian normalizers to the input and output data, per component.
+
+        Returns:
+            tuple: The input and output UnitGaussianNormalizer.
+        '''
+        x_normalizer = UnitGaussianNormalizer(self.x.reshape(-1, self.x.shape[-1]).data.numpy())
+        y_normalizer = UnitGaussianNormalizer(self.y.reshape(-1, self.y.shape[-1]).data.numpy())
+        return x_normalizer, y_normalizer
+
 class DynamicsDataModule(pl.LightningDataModule):
     """
     LightningDataModule for handling dynamics datasets.
@@ -458,6 +881,20 @@ class DynamicsDataModule(pl.LightningDataModule):
         dyn_sys_name (str): The name of the dynamics system. Default is 'Lorenz63'.
         input_inds (list): A list of indices specifying the input variables. Default is [0].
         output_inds (list): A list of indices specifying the output variables. Default is [-1].
+        cache_dir (str): Directory of the on-disk trajectory cache. Default is None (solve on every setup).
+        seed (int): Seed of the cached trajectories. Default is 0.
+        generation_workers (int): Number of processes solving trajectories on a cache miss. Default is 1.
+        generation_chunk_size (int): Number of trajectories per seeded chunk on a cache miss. Default is 1000.
+        multirate_test (bool): Solve the test trajectories once on the union of the test time grids, so that every
+                               test sample rate sees the same trajectories. Default is False.
+        num_workers (int): Number of DataLoader worker processes. Default is 0 (load in the main process).
+        pin_memory (bool): Whether the DataLoaders copy batches into page-locked memory. Default is False.
+        persistent_workers (bool): Whether the DataLoader workers are kept alive between epochs. Default is False.
+        prefetch_factor (int): Batches loaded in advance by each worker. Default is None (the DataLoader default).
+        shuffle (bool): Whether the training set is reshuffled every epoch. Default is False.
+        tensor_batching (bool): Whether whole batches are sliced out of the in-memory datasets (see TensorBatches)
+                                instead of collating samples. Default is False.
+        data_device (str): Device where tensor batching keeps the datasets. Default is None (host memory).
         **kwargs: Additional keyword arguments.
 
     Attributes:
@@ -470,6 +907,12 @@ class DynamicsDataModule(pl.LightningDataModule):
         dyn_sys_name (str): The name of the dynamics system.
         input_inds (list): A list of indices specifying the input variables.
         output_inds (list): A list of indices specifying the output variables.
+        cache_kwargs (dict): Cache settings passed to every DynamicsDataset.
+        multirate_test (bool): Whether the test sets share one solve.
+        loader_kwargs (dict): DataLoader settings passed to make_dataloader.
+        shuffle (bool): Whether the training set is reshuffled every epoch.
+        tensor_batching (bool): Whether whole batches are sliced out of the in-memory datasets.
+        data_device (str): Device where tensor batching keeps the datasets.
     """
 
     def __init__(self,
@@ -481,6 +924,18 @@ class DynamicsDataModule(pl.LightningDataModule):
                  params={},
                  dyn_sys_name='Lorenz63',
                  input_inds=[0], output_inds=[-1],
+                 cache_dir=None,
+                 seed=0,
+                 generation_workers=1,
+                 generation_chunk_size=1000,
+                 multirate_test=False,
+                 num_workers=0,
+                 pin_memory=False,
+                 persistent_workers=False,
+                 prefetch_factor=None,
+                 shuffle=False,
+                 tensor_batching=False,
+                 data_device=None,
                  **kwargs
                  ):
         super().__init__()
@@ -493,6 +948,17 @@ class DynamicsDataModule(pl.LightningDataModule):
         self.dyn_sys_name = dyn_sys_name
         self.input_inds = input_inds
         self.output_inds = output_inds
+        self.cache_kwargs = {'cache_dir': cache_dir, 'seed': seed,
+                             'num_workers': generation_workers, 'chunk_size': generation_chunk_size}
+        self.multirate_test = multirate_test
+        self.loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory,
+                              'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor}
+        self.shuffle = shuffle
+        self.tensor_batching = tensor_batching
+        self.data_device = data_device
+        self.dataloaders = {}
+        self.tensor_batches = {}
+        self.x_normalizer, self.y_normalizer = None, None
 
     def setup(self, stage: str):
         """
@@ -504,6 +970,10 @@ class DynamicsDataModule(pl.LightningDataModule):
         Returns:
             None
         """
+        # loaders of the previous datasets are stale
+        self.reset_dataloaders()
+        self.tensor_batches = {}
+
         # Assign train/val datasets for use in dataloaders
         self.train = DynamicsDataset(size=self.size['train'],
                                      T=self.T['train'],
@@ -511,7 +981,9 @@ class DynamicsDataModule(pl.LightningDataModule):
                                      params=self.params,
                                      dyn_sys_name=self.dyn_sys_name,
                                      input_inds=self.input_inds,
-                                     output_inds=self.output_inds)
+                                     output_inds=self.output_inds,
+                                     split='train',
+                                     **self.cache_kwargs)
 
         self.val = DynamicsDataset(size=self.size['val'],
                                    T=self.T['val'],
@@ -519,7 +991,18 @@ class DynamicsDataModule(pl.LightningDataModule):
                                    params=self.params,
                                    dyn_sys_name=self.dyn_sys_name,
                                    input_inds=self.input_inds,
-                                   output_inds=self.output_inds)
+                                   output_inds=self.output_inds,
+                                   split='val',
+                                   **self.cache_kwargs)
+
+        test_trajectories = {dt: None for dt in self.test_sample_rates}
+        if self.multirate_test:
+            # one solve on the union of the test grids instead of one solve per sample rate
+            params = dict(self.params, size=self.size['test'])
+            dynsys = load_dyn_sys_class(self.dyn_sys_name)(params=params)
+            solved = load_trajectories(dynsys, self.dyn_sys_name, params, self.size['test'], self.T['test'],
+                                       list(self.test_sample_rates), test=True, split='test', **self.cache_kwargs)
+            test_trajectories = split_multirate(*solved, self.T['test'], self.test_sample_rates)
 
         # build a dictionary of test datasets with different sample rates
         self.test = {}
@@ -531,7 +1014,39 @@ class DynamicsDataModule(pl.LightningDataModule):
                                             dyn_sys_name=self.dyn_sys_name,
                                             input_inds=self.input_inds,
                                             output_inds=self.output_inds,
-                                            test=True)
+                                            test=True,
+                                            split='test',
+                                            trajectories=test_trajectories[dt],
+                                            **self.cache_kwargs)
+
+    def normalizers(self):
+        '''statistics of the training data, applied to every split by the LightningModule, fitted on first use after setup'''
+        if self.x_normalizer is None:
+            self.x_normalizer, self.y_normalizer = self.train.fit_normalizers()
+        return self.x_normalizer, self.y_normalizer
+
+    def reset_dataloaders(self):
+        '''shuts down the workers of the cached loaders, which are built again on next use'''
+        for batch_size, loader in self.dataloaders.values():
+            shutdown_workers(loader)
+        self.dataloaders = {}
+
+    def dataloader(self, split, dataset, shuffle=False):
+        # one (batch_size, loader) per split, so persistent workers are reused across epochs. The batch size tuner
+        # changes the batch size, the previous loader is then replaced and its workers shut down
+        if split in self.dataloaders and self.dataloaders[split][0] != self.batch_size:
+            shutdown_workers(self.dataloaders.pop(split)[1])
+        if split not in self.dataloaders:
+            if self.tensor_batching and not getattr(dataset, 'lazy', False):
+                # one copy of the split, on data_device, for all batch sizes
+                if split not in self.tensor_batches:
+                    self.tensor_batches[split] = TensorBatches(dataset, self.data_device)
+                loader = make_tensor_dataloader(self.tensor_batches[split], self.batch_size, shuffle=shuffle,
+                                                pin_memory=self.loader_kwargs['pin_memory'])
+            else:
+                loader = make_dataloader(dataset, self.batch_size, shuffle=shuffle, **self.loader_kwargs)
+            self.dataloaders[split] = (self.batch_size, loader)
+        return self.dataloaders[split][1]
 
     def train_dataloader(self):
         """
@@ -540,7 +1055,7 @@ class DynamicsDataModule(pl.LightningDataModule):
         Returns:
             torch.utils.data.DataLoader: A dataloader for the train dataset.
         """
-        return DataLoader(self.train, batch_size=self.batch_size)
+        return self.dataloader('train', self.train, shuffle=self.shuffle)
 
     def val_dataloader(self):
         """
@@ -549,7 +1064,7 @@ class DynamicsDataModule(pl.LightningDataModule):
         Returns:
             torch.utils.data.DataLoader: A dataloader for the validation dataset.
         """
-        return DataLoader(self.val, batch_size=self.batch_size)
+        return self.dataloader('val', self.val)
 
     def test_dataloader(self, sample_rate=None):
         """
@@ -562,11 +1077,241 @@ class DynamicsDataModule(pl.LightningDataModule):
             dict: A dictionary of dataloaders for the test dataset.
         """
         if sample_rate is None:
-            return {dt: DataLoader(self.test[dt], batch_size=self.batch_size) for dt in self.test_sample_rates}
+            return {dt: self.dataloader(('test', dt), self.test[dt]) for dt in self.test_sample_rates}
         else:
-            return DataLoader(self.test[sample_rate], batch_size=self.batch_size)
+            return self.dataloader(('test', sample_rate), self.test[sample_rate])
 
 ############ Spatial 2D data set ################
+
+# test files of the other resolutions, by the stride that the patch models use for them
+TEST_RESOLUTION_SUFFIXES = {2: '_half', 0.5: '_double', 0.75: '_midhigh', 1.5: '_midlow'}
+
+
+def relayout_samples_first(fname, out_fname, keys=('x', 'y'), block_size=64):
+    '''
+    Write a copy of a (rows, cols, N) HDF5 file with the samples along the first axis and one chunk per sample, so
+    that reading a sample is a single contiguous read. The copy is written once, in blocks of samples, to a temporary
+    file that is renamed into place, and reused afterwards.
+
+    Args:
+        fname (str): The HDF5 file, with datasets of shape (rows, cols, N).
+        out_fname (str): The samples-first copy, with datasets of shape (N, rows, cols).
+        keys (tuple): The datasets to copy.
+        block_size (int): Number of samples copied at a time.
+
+    Returns:
+        str: out_fname.
+    '''
+    if os.path.exists(out_fname):
+        return out_fname
+    os.makedirs(os.path.dirname(os.path.abspath(out_fname)), exist_ok=True)
+    tmp_fname = f'{out_fname}.tmp{os.getpid()}'
+    with h5py.File(fname, 'r') as f, h5py.File(tmp_fname, 'w') as out:
+        for key in keys:
+            rows, cols, total_samples = f[key].shape
+            dataset = out.create_dataset(key, shape=(total_samples, rows, cols), dtype=f[key].dtype, chunks=(1, rows, cols))
+            for start in range(0, total_samples, block_size):
+                dataset[start:start+block_size] = np.transpose(f[key][:, :, start:start+block_size], (2, 0, 1))
+    os.replace(tmp_fname, out_fname)
+    return out_fname
+
+
+def convert_pt_to_npy(fname, out_dir):
+    '''
+    One-time conversion of a Navier-Stokes .pt file of shape (N, rows, cols, 2) into x and y .npy files of shape
+    (N, rows, cols). These are memory-mapped by NpySamples, so jobs on one node share the page cache instead of each
+    holding a private copy. Existing conversions are reused.
+
+    Args:
+        fname (str): The .pt file, channel 0 is the input and channel 1 the output.
+        out_dir (str): Directory of the .npy files.
+
+    Returns:
+        tuple: The x and y .npy files.
+    '''
+    base = os.path.join(out_dir, os.path.basename(fname))
+    out_fnames = (base + '.x.npy', base + '.y.npy')
+    if all(os.path.exists(out_fname) for out_fname in out_fnames):
+        return out_fnames
+    os.makedirs(out_dir, exist_ok=True)
+    file = torch.load(fname).numpy()
+    for channel, out_fname in enumerate(out_fnames):
+        # written to a temporary file that is renamed into place, so concurrent jobs never map a partial file
+        tmp_fname = f'{out_fname}.tmp{os.getpid()}.npy'
+        np.save(tmp_fname, file[..., channel])
+        os.replace(tmp_fname, out_fname)
+    return out_fnames
+
+
+class LazySamples(object):
+    '''
+    Samples of shape (rows, cols) that are read on demand, optionally restricted to a subset of the samples and to a
+    subset of the grid points. Only metadata is read on construction. The file is opened on first access in each
+    process, so every DataLoader worker reads through its own handle. Subclasses implement open, full_shape, read and
+    read_span.
+
+    Args:
+        fname (str): The file.
+        indices (array-like): The samples, None for all of them.
+        points (np.ndarray): (row, col) indices of shape (n_points, 2) read from each sample, None for the full grid.
+                             A sample is then returned as float32 of shape (n_points, 1), as from subsample_and_flatten.
+    '''
+    def __init__(self, fname, indices=None, points=None):
+        self.fname = fname
+        self.handle = None
+        self.pid = None
+        total_samples, rows, cols = self.full_shape()
+        self.indices = np.arange(total_samples) if indices is None else np.asarray(indices)
+        self.points = points
+        self.shape = (len(self.indices), rows, cols)
+
+    @property
+    def data(self):
+        if self.handle is None or self.pid != os.getpid():
+            self.handle = self.open()
+            self.pid = os.getpid()
+        return self.handle
+
+    def __getstate__(self):
+        # file handles are not pickled, every process opens its own
+        state = dict(self.__dict__)
+        state['handle'] = None
+        return state
+
+    def subset(self, indices=None, points=None):
+        '''a view of some of the samples (positions in this view) and/or of some of the grid points'''
+        view = copy.copy(self)
+        if indices is not None:
+            view.indices = self.indices[np.asarray(indices)]
+            view.shape = (len(view.indices),) + self.shape[1:]
+        if points is not None:
+            view.points = points
+        return view
+
+    def __len__(self):
+        return self.shape[0]
+
+    def select(self, samples):
+        # samples: (..., rows, cols)
+        if self.points is None:
+            return samples
+        return samples[..., self.points[:, 0], self.points[:, 1]].astype('float32')[..., None]
+
+    def __getitem__(self, idx):
+        return self.select(self.read(int(self.indices[idx])))
+
+    def read_block(self, start, stop):
+        '''samples start to stop, shape (stop-start, ...)'''
+        # one contiguous read of the span of the (sorted) indices is much faster than reading an index list
+        block = self.indices[start:stop]
+        return self.select(self.read_span(block[0], block[-1] + 1)[block - block[0]])
+
+    def fit_normalizer(self, block_size=64, num_workers=1, cache_dir=None):
+        '''
+        UnitGaussianNormalizer of all values, as UnitGaussianNormalizer(samples.reshape(-1, 1)) of the samples in memory
+        would give up to rounding, streamed over blocks of samples and merged in float64.
+
+        Args:
+            block_size (int): Number of samples read at a time.
+            num_workers (int): Number of processes fitting parts of the blocks, their statistics are merged.
+            cache_dir (str): Directory where the statistics are stored and looked up by later jobs, None to always fit.
+
+        Returns:
+            UnitGaussianNormalizer: The fitted normalizer.
+        '''
+        if cache_dir is not None:
+            fname = os.path.join(cache_dir, f'stats_{self.stats_key()}.npz')
+            if os.path.exists(fname):
+                return UnitGaussianNormalizer.load(fname)
+
+        starts = np.arange(0, len(self), block_size)
+        parts = [part for part in np.array_split(starts, num_workers) if len(part)]
+        if len(parts) > 1:
+            # fork, so that scripts without a __main__ guard are not re-run by the workers
+            with ProcessPoolExecutor(max_workers=len(parts), mp_context=multiprocessing.get_context('fork')) as pool:
+                partials = list(pool.map(self.fit_blocks, parts, [block_size] * len(parts)))
+        else:
+            partials = [self.fit_blocks(starts, block_size)]
+        normalizer = UnitGaussianNormalizer()
+        for partial in partials:
+            normalizer.merge(partial)
+
+        # statistics in the dtype of the samples, as np.mean and np.std return them
+        dtype = np.float32 if self.points is not None else self.data.dtype
+        normalizer.mean, normalizer.std = normalizer.mean.astype(dtype), normalizer.std.astype(dtype)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            normalizer.save(fname)
+        return normalizer
+
+    def fit_blocks(self, starts, block_size):
+        '''UnitGaussianNormalizer accumulated over the blocks of samples starting at starts'''
+        normalizer = UnitGaussianNormalizer()
+        for start in starts:
+            normalizer.update(self.read_block(start, start + block_size).reshape(-1, 1))
+        return normalizer
+
+    def stats_key(self):
+        '''content address of the values of this view: the file, its version, the samples and the grid points'''
+        stat = os.stat(self.fname)
+        spec = {'fname': os.path.abspath(self.fname), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'key': getattr(self, 'key', None),
+                'indices': hashlib.sha1(np.ascontiguousarray(self.indices, dtype=np.int64)).hexdigest(),
+                'points': None if self.points is None else hashlib.sha1(np.ascontiguousarray(self.points, dtype=np.int64)).hexdigest()}
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+class H5Samples(LazySamples):
+    '''
+    LazySamples of a dataset of an HDF5 file.
+
+    Args:
+        fname (str): The HDF5 file.
+        key (str): The dataset, e.g. 'x' or 'y'.
+        samples_first (bool): Whether the dataset is (N, rows, cols), as written by relayout_samples_first, rather
+                              than (rows, cols, N), as in the .mat files.
+        indices, points: As in LazySamples.
+    '''
+    def __init__(self, fname, key, samples_first=False, indices=None, points=None):
+        self.key = key
+        self.samples_first = samples_first
+        super().__init__(fname, indices=indices, points=points)
+
+    def open(self):
+        return h5py.File(self.fname, 'r')[self.key]
+
+    def full_shape(self):
+        shape = self.data.shape
+        return shape if self.samples_first else (shape[2],) + shape[:2]
+
+    def read(self, i):
+        return self.data[i] if self.samples_first else self.data[:, :, i]
+
+    def read_span(self, low, high):
+        return self.data[low:high] if self.samples_first else np.transpose(self.data[:, :, low:high], (2, 0, 1))
+
+
+class NpySamples(LazySamples):
+    '''
+    LazySamples of a memory-mapped (N, rows, cols) .npy file, served as zero-copy views of the page cache.
+
+    Args:
+        fname (str): The .npy file, e.g. from convert_pt_to_npy.
+        indices, points: As in LazySamples.
+    '''
+    def open(self):
+        return np.load(self.fname, mmap_mode='r')
+
+    def full_shape(self):
+        return self.data.shape
+
+    def read(self, i):
+        return self.data[i]
+
+    def read_span(self, low, high):
+        return self.data[low:high]
+
+
 class Spatial2dDataModule(pl.LightningDataModule):
     def __init__(self,
                  batch_size=64,
@@ -578,6 +1323,16 @@ class Spatial2dDataModule(pl.LightningDataModule):
                  dyn_sys_name='darcy_low_res',
                  random_state=0,
                  patch=False,
+                 lazy_loading=False, # read the samples on demand instead of loading the splits
+                 relayout_dir=None, # directory of the samples-first HDF5 copies and .npy conversions read by lazy loading, and of the persisted normalizer statistics
+                 stats_workers=1, # processes streaming the normalizer statistics with lazy loading
+                 num_workers=0, # DataLoader worker processes, 0 to load in the main process
+                 pin_memory=False, # copy batches into page-locked memory
+                 persistent_workers=False, # keep the DataLoader workers alive between epochs
+                 prefetch_factor=None, # batches loaded in advance by each worker, None for the DataLoader default
+                 shuffle=False, # reshuffle the training set every epoch
+                 tensor_batching=False, # slice whole batches out of the in-memory splits instead of collating samples
+                 data_device=None, # device where tensor batching keeps the splits, None to keep them in host memory
                  **kwargs
                  ):
         super().__init__()
@@ -589,8 +1344,76 @@ class Spatial2dDataModule(pl.LightningDataModule):
         self.dyn_sys_name = dyn_sys_name
         self.random_state = random_state
         self.patch = patch
+        self.lazy_loading = lazy_loading
+        self.relayout_dir = relayout_dir
+        self.stats_workers = stats_workers
+        self.loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory,
+                              'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor}
+        self.shuffle = shuffle
+        self.tensor_batching = tensor_batching
+        self.data_device = data_device
+        self.dataloaders = {}
+        self.tensor_batches = {}
+        self.x_normalizer, self.y_normalizer = None, None
+
+        if self.lazy_loading:
+            self.make_lazy_splits(split_frac)
+        else:
+            self.make_splits(split_frac)
+
+    def lazy_samples(self, dyn_sys_name):
+        '''
+        Lazy x and y samples of the file of dyn_sys_name. Navier-Stokes .pt files are read through their .npy conversion,
+        in relayout_dir or next to the .pt file, and HDF5 files through their samples-first copy if relayout_dir is set.
+        '''
+        fname = load_dyn_sys_class(dyn_sys_name)
+        if fname.endswith('.pt'):
+            x_fname, y_fname = convert_pt_to_npy(fname, self.relayout_dir or os.path.dirname(fname))
+            return NpySamples(x_fname), NpySamples(y_fname)
+        samples_first = self.relayout_dir is not None
+        if samples_first:
+            fname = relayout_samples_first(fname, os.path.join(self.relayout_dir, os.path.basename(fname) + '.samples_first.h5'))
+        return H5Samples(fname, 'x', samples_first), H5Samples(fname, 'y', samples_first)
+
+    def make_lazy_splits(self, split_frac):
+        '''
+        Lazy counterpart of make_splits: the same splits, but only metadata is read here and the datasets read their
+        samples on demand.
+        '''
+        x_all, y_all = self.lazy_samples(self.dyn_sys_name)
 
-        self.make_splits(split_frac)
+        # the same shuffle as make_splits
+        total_samples = len(x_all)
+        indices = np.arange(total_samples)
+        np.random.seed(self.random_state)
+        np.random.shuffle(indices)
+
+        train_size = int(split_frac['train'] * total_samples)
+        val_size = int(split_frac['val'] * total_samples)
+
+        train_indices = sorted(indices[:train_size].tolist())
+        val_indices = sorted(indices[train_size:(train_size + val_size)].tolist())
+        test_indices = sorted(indices[(train_size + val_size):].tolist())
+
+        x_train, y_train = x_all.subset(train_indices), y_all.subset(train_indices)
+        x_val, y_val = x_all.subset(val_indices), y_all.subset(val_indices)
+        x_test, y_test = x_all.subset(test_indices), y_all.subset(test_indices)
+
+        # define sets
+        self.x_train, self.y_train, self.active_coordinates_x, self.active_coordinates_y = self.sample(x_train, y_train, self.train_sample_stride)
+        self.x_val, self.y_val, _, _ = self.sample(x_val, y_val, self.train_sample_stride)
+
+        # define test sets, patch models are tested on the files of the other resolutions
+        self.x_test, self.y_test = {}, {}
+        self.active_coordinates_x_test, self.active_coordinates_y_test = {}, {}
+        for stride in self.test_sample_rates:
+            if not self.patch or stride == 1:
+                x, y = x_test, y_test
+            elif stride in TEST_RESOLUTION_SUFFIXES:
+                x, y = self.lazy_samples(self.dyn_sys_name + TEST_RESOLUTION_SUFFIXES[stride])
+            else:
+                raise ValueError(f"Stride {stride} not supported for patch or fourier")
+            self.x_test[stride], self.y_test[stride], self.active_coordinates_x_test[stride], self.active_coordinates_y_test[stride] = self.sample(x, y, stride, test=True)
 
     def make_splits(self, split_frac):
 
@@ -724,6 +1547,14 @@ class Spatial2dDataModule(pl.LightningDataModule):
             active_coordinates_x = patch_coords(x)
             active_coordinates_y = patch_coords(y)
 
+        elif isinstance(x, LazySamples):
+
+            # the points of subsample_and_flatten, read from each sample on demand
+            points_x = np.array(subsample_indices(x.shape[1], x.shape[2], stride))
+            points_y = np.array(subsample_indices(y.shape[1], y.shape[2], stride))
+            x, y = x.subset(points=points_x), y.subset(points=points_y)
+            active_coordinates_x, active_coordinates_y = points_x.astype('float32'), points_y.astype('float32')
+
         else:
 
             # x, y are (N, length, width)
@@ -743,67 +1574,98 @@ class Spatial2dDataModule(pl.LightningDataModule):
 
     def setup(self, stage: str):
 
+        # loaders of the previous datasets are stale
+        self.reset_dataloaders()
+        self.tensor_batches = {}
+
         # Assign train/val datasets for use in dataloaders
         self.train = Spatial2dDataset(self.x_train, self.y_train,
                                       self.active_coordinates_x, self.active_coordinates_y)
 
         self.val = Spatial2dDataset(self.x_val, self.y_val,
-                            self.active_coordinates_x, self.active_coordinates_y,
-                            x_normalizer=self.train.x_normalizer,
-                            y_normalizer=self.train.y_normalizer)
+                            self.active_coordinates_x, self.active_coordinates_y)
 
         # build a dictionary of test datasets with different sample rates
         self.test = {}
         for stride in self.test_sample_rates:
             self.test[stride] = Spatial2dDataset(self.x_test[stride], self.y_test[stride],
                                     self.active_coordinates_x_test[stride], self.active_coordinates_y_test[stride],
-                                    x_normalizer=self.train.x_normalizer,
-                                    y_normalizer=self.train.y_normalizer,
                                     test=True,
                                     )
 
+    def normalizers(self):
+        '''statistics of the training data, applied to every split by the LightningModule, fitted on first use after setup'''
+        if self.x_normalizer is None:
+            self.x_normalizer, self.y_normalizer = self.train.fit_normalizers(num_workers=self.stats_workers,
+                                                                              cache_dir=self.relayout_dir)
+        return self.x_normalizer, self.y_normalizer
+
+    def reset_dataloaders(self):
+        '''shuts down the workers of the cached loaders, which are built again on next use'''
+        for batch_size, loader in self.dataloaders.values():
+            shutdown_workers(loader)
+        self.dataloaders = {}
+
+    def dataloader(self, split, dataset, shuffle=False):
+        # one (batch_size, loader) per split, so persistent workers are reused across epochs. The batch size tuner
+        # changes the batch size, the previous loader is then replaced and its workers shut down
+        if split in self.dataloaders and self.dataloaders[split][0] != self.batch_size:
+            shutdown_workers(self.dataloaders.pop(split)[1])
+        if split not in self.dataloaders:
+            if self.tensor_batching and not getattr(dataset, 'lazy', False):
+                # one copy of the split, on data_device, for all batch sizes
+                if split not in self.tensor_batches:
+                    self.tensor_batches[split] = TensorBatches(dataset, self.data_device)
+                loader = make_tensor_dataloader(self.tensor_batches[split], self.batch_size, shuffle=shuffle,
+                                                pin_memory=self.loader_kwargs['pin_memory'])
+            else:
+                loader = make_dataloader(dataset, self.batch_size, shuffle=shuffle, **self.loader_kwargs)
+            self.dataloaders[split] = (self.batch_size, loader)
+        return self.dataloaders[split][1]
+
     def train_dataloader(self):
-        return DataLoader(self.train, batch_size=self.batch_size)
+        return self.dataloader('train', self.train, shuffle=self.shuffle)
 
     def val_dataloader(self):
-        return DataLoader(self.val, batch_size=self.batch_size)
+        return self.dataloader('val', self.val)
 
     def test_dataloader(self, sample_rate=None):
-        return {dt: DataLoader(self.test[dt], batch_size=self.batch_size) for dt in self.test_sample_rates}
+        return {dt: self.dataloader(('test', dt), self.test[dt]) for dt in self.test_sample_rates}
 
 class Spatial2dDataset(Dataset):
     def __init__(self, x, y,
                 active_coordinates_x,
                 active_coordinates_y,
-                x_normalizer=None,
-                y_normalizer=None,
                 **kwargs):
         '''x: (N, length, width)
            y: (N, length, width)
         '''
         self.active_coordinates_x = active_coordinates_x
         self.active_coordinates_y = active_coordinates_y
-        self.generate_data(x, y, x_normalizer, y_normalizer)
+        self.generate_data(x, y)
 
-    def generate_data(self, x, y, x_normalizer, y_normalizer):
+    def generate_data(self, x, y):
         '''x: (N, length, width)
            y: (N, length, width)'''
 
-        # compute normalization
-        if x_normalizer is None or y_normalizer is None:
-            #normalize data
-            self.x_normalizer = UnitGaussianNormalizer(x.reshape(-1,1))
-            self.y_normalizer = UnitGaussianNormalizer(y.reshape(-1,1))
-        else:
-            self.x_normalizer = x_normalizer
-            self.y_normalizer = y_normalizer
+        # the data is stored unnormalized, the LightningModule normalizes batches on device (see fit_normalizers)
+        # lazily read samples stay on disk
+        self.lazy = isinstance(x, LazySamples)
+        self.x, self.y = x, y
 
-        # apply normalization
-        self.x = self.x_normalizer.encode(x)
-        self.y = self.y_normalizer.encode(y)
+    def fit_normalizers(self, num_workers=1, cache_dir=None):
+        '''
+        returns unit Gaussian normalizers (x_normalizer, y_normalizer) fitted to all values of x and y, lazily read
+        samples are streamed by num_workers processes and their statistics persisted in cache_dir (see
+        LazySamples.fit_normalizer)
+        '''
+        if self.lazy:
+            return (self.x.fit_normalizer(num_workers=num_workers, cache_dir=cache_dir),
+                    self.y.fit_normalizer(num_workers=num_workers, cache_dir=cache_dir))
+        return UnitGaussianNormalizer(self.x.reshape(-1,1)), UnitGaussianNormalizer(self.y.reshape(-1,1))
 
     def __len__(self):
         return self.x.shape[0]
 
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.active_coordinates_x, self.active_coordinates_y
\ No newline at end of file
+        return self.x[idx], self.y[idx], self.active_coordinates_x, self.active_coordinates_y
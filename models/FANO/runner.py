@@ -8,6 +8,7 @@ from pytorch_lightning.tuner import Tuner
 
 # Import custom modules
 from datasets import MetaDataModule
+from callbacks import NormMonitor
 from models.FANO.FANO_lightning import SimpleEncoderModule
 
 
@@ -21,6 +22,9 @@ class Runner:
             output_inds=[-1],
             split_frac={}, # used for 2d spatial, but not in timeseries (just a choice vs n_traj),
             random_state=0, # used for 2d spatial, added for reproducibility of test error plots
+            lazy_loading=False, # used for 2d spatial, read samples on demand instead of loading the splits
+            relayout_dir=None, # used for 2d spatial, directory of the samples-first copies and .npy conversions read by lazy loading
+            stats_workers=1, # used for 2d spatial, processes streaming the normalizer statistics with lazy loading
             n_trajectories_train=10000,
             n_trajectories_val=200,
             n_trajectories_test=200,
@@ -31,6 +35,13 @@ class Runner:
             test_patch_sizes=[8,16,32],
             batch_size=32,
             tune_batch_size=False,
+            num_workers=0, # DataLoader worker processes, 0 to load batches in the main process
+            pin_memory=False, # page-locked batches, for faster host to GPU copies
+            persistent_workers=False, # keep the DataLoader workers alive between epochs
+            prefetch_factor=None, # batches loaded in advance by each worker, None for the DataLoader default
+            shuffle=False, # reshuffle the training set every epoch
+            tensor_batching=False, # slice whole batches out of the in-memory datasets instead of collating samples
+            data_device=None, # device where tensor batching keeps the datasets, e.g. 'cuda', None for host memory
             dyn_sys_name='Rossler',
             monitor_metric='loss/val/mse',
             lr_scheduler_params={'patience': 2, 'factor': 0.1},
@@ -51,8 +62,10 @@ class Runner:
             dropout=0.01,
             dim_feedforward=128,
             activation='gelu',
+            attention_memory_budget=None, # bytes of temporaries per patch attention call, None for the full score tensor
             max_epochs=100,
             log_every_n_steps=10,
+            norm_log_every_n_steps=50, # optimizer steps between gradient and parameter norm logs, None to disable them
             gradient_clip_val=10.0,
             gradient_clip_algorithm="value",
             overfit_batches=0.0):
@@ -77,11 +90,21 @@ class Runner:
                                  'test_patch_sizes': test_patch_sizes,
                                  'batch_size': batch_size,
                                  'tune_batch_size': tune_batch_size,
+                                 'num_workers': num_workers,
+                                 'pin_memory': pin_memory,
+                                 'persistent_workers': persistent_workers,
+                                 'prefetch_factor': prefetch_factor,
+                                 'shuffle': shuffle,
+                                 'tensor_batching': tensor_batching,
+                                 'data_device': data_device,
                                  'dyn_sys_name': dyn_sys_name,
                                  'patch': patch, # used for 2d spatial, but not in timeseries
                                  'patch_size': patch_size, # used for 2d spatial, but not in timeseries
                                  'input_inds': input_inds,
                                  'output_inds': output_inds,
+                                 'lazy_loading': lazy_loading,
+                                 'relayout_dir': relayout_dir,
+                                 'stats_workers': stats_workers,
                                  }
 
         self.model_hyperparams = {'input_dim': len(input_inds),
@@ -105,6 +128,7 @@ class Runner:
                                   'dropout': dropout,
                                   'dim_feedforward': dim_feedforward,
                                   'activation': activation,
+                                  'attention_memory_budget': attention_memory_budget,
                                   # add extra sequence to allow for inclusion of output I.C.
                                   'max_sequence_length': 1 + int(T/min(test_sample_rates)) + len(output_inds),
                                   }
@@ -118,6 +142,7 @@ class Runner:
                                     }
 
         self.other_hyperparams = {'seed': seed, 'tune_initial_lr': tune_initial_lr,
+                                  'norm_log_every_n_steps': norm_log_every_n_steps,
                                   }
 
         self.run()
@@ -155,6 +180,8 @@ class Runner:
         # aggregate all callbacks
         #callbacks = [lr_monitor, early_stopping, custom_checkpoint_saver_callback]
         callbacks = [lr_monitor, early_stopping]
+        if self.other_hyperparams['norm_log_every_n_steps'] is not None:
+            callbacks.append(NormMonitor(log_every_n_steps=self.other_hyperparams['norm_log_every_n_steps']))
 
 
         # Initialize the trainer
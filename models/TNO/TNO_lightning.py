@@ -7,6 +7,8 @@ import pytorch_lightning as pl
 import wandb
 import matplotlib.pyplot as plt
 
+from datasets import transfer_shared_coords
+from utils import TorchUnitGaussianNormalizer
 from models.TNO.TNO_pytorch import SimpleEncoder
 
 # Define the pytorch lightning module for training the Simple Encoder model
@@ -27,7 +29,10 @@ class SimpleEncoderModule(pl.LightningModule):
                                       'factor': 0.5},
                  dropout=0.1,
                  norm_first=False,
-                 dim_feedforward=2048):
+                 dim_feedforward=2048,
+                 attention_chunk_size=None,
+                 quadrature='trapezoid',
+                 attention_kernel='softmax'):
         super(SimpleEncoderModule, self).__init__()
         self.first_forward = True # for plotting model-related things once at beginnning of training
         self.d_model = d_model
@@ -64,10 +69,17 @@ class SimpleEncoderModule(pl.LightningModule):
                                     activation=activation,
                                     dropout=dropout,
                                     norm_first=norm_first,
-                                    dim_feedforward=dim_feedforward)
+                                    dim_feedforward=dim_feedforward,
+                                    attention_chunk_size=attention_chunk_size,
+                                    quadrature=quadrature,
+                                    attention_kernel=attention_kernel)
         
         self.test_losses = {}
 
+        # statistics of the training data, set in setup and saved in the checkpoints
+        self.x_normalizer = TorchUnitGaussianNormalizer(input_dim)
+        self.y_normalizer = TorchUnitGaussianNormalizer(output_dim)
+
     def forward(self, x, y, coords_x, coords_y):
         coords_x = coords_x[0].unsqueeze(2)
         coords_y = coords_y[0].unsqueeze(2)
@@ -80,6 +92,25 @@ class SimpleEncoderModule(pl.LightningModule):
         else: 
             return self.model(x, y=None, coords_x=coords_x)
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # coordinates shared by the batch are moved once, see shared_coords_collate
+        transfer = super().transfer_batch_to_device
+        return transfer_shared_coords(batch, device, lambda b, d: transfer(b, d, dataloader_idx))
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # the datasets store unnormalized data, batches are normalized here, on device
+        x, y, coords_x, coords_y = batch
+        return self.x_normalizer.encode(x), self.y_normalizer.encode(y), coords_x, coords_y
+
+    def setup(self, stage):
+        # fitting uses the statistics of the training data, otherwise they are loaded from a checkpoint and only
+        # refitted for checkpoints saved without them
+        datamodule = self.trainer.datamodule
+        if (stage == 'fit' or not self.x_normalizer.fitted) and hasattr(datamodule, 'normalizers'):
+            x_normalizer, y_normalizer = datamodule.normalizers()
+            self.x_normalizer.set_stats(x_normalizer)
+            self.y_normalizer.set_stats(y_normalizer)
+
     def training_step(self, batch, batch_idx):
         x, y, coords_x, coords_y = batch
         y_hat = self.forward(x, y, coords_x, coords_y)
@@ -105,32 +136,6 @@ class SimpleEncoderModule(pl.LightningModule):
         loss_dict = {"l2": loss, "l2_rel": rel_loss}
         return loss_dict[self.loss_name]
 
-    def on_after_backward(self):
-        self.log_gradient_norms(tag='afterBackward')
-
-    def on_before_optimizer_step(self, optimizer):
-        # Compute the 2-norm for each layer and its gradient
-        # If using mixed precision, the gradients are already unscaled here
-        self.log_gradient_norms(tag='beforeOptimizer')
-        self.log_parameter_norms(tag='beforeOptimizer')
-
-    def log_gradient_norms(self, tag=''):
-        norm_type = 2.0
-        for name, param in self.named_parameters():
-            if param.grad is not None:
-                grad_norm = param.grad.detach().norm(norm_type)
-                name = name.replace('.', '_')
-                self.log(f"grad_norm/{tag}/{name}", grad_norm,
-                         on_step=False, on_epoch=True, prog_bar=False)
-
-    def log_parameter_norms(self, tag=''):
-        norm_type = 2.0
-        for name, param in self.named_parameters():
-            param_norm = param.detach().norm(norm_type)
-            name = name.replace('.', '_')
-            self.log(f"param_norm/{tag}/{name}", param_norm,
-                     on_step=False, on_epoch=True, prog_bar=False)
-
     def validation_step(self, batch, batch_idx):
         x, y, coords_x, coords_y = batch
         y_hat = self.forward(x, y, coords_x, coords_y)
@@ -568,6 +573,11 @@ class SimpleEncoderModule(pl.LightningModule):
                 if batch_idx == worst_batch_idx:
                     worst_batch = batch
 
+            # normalized on device, as the batches seen by test_step
+            median_batch = self.on_after_batch_transfer(
+                self.transfer_batch_to_device(median_batch, self.device, dataloader_idx), dataloader_idx)
+            worst_batch = self.on_after_batch_transfer(
+                self.transfer_batch_to_device(worst_batch, self.device, dataloader_idx), dataloader_idx)
 
             median_sample = [median_batch[i][median_sample_idx] for i in range(4)]+[dataloader_losses['prediction'][median_idx], dataloader_losses['losses'][median_idx]]
             worst_sample =  [worst_batch[i][worst_sample_idx] for i in range(4)]+[dataloader_losses['prediction'][worst_idx], dataloader_losses['losses'][worst_idx]]
@@ -4,6 +4,8 @@ import torch.nn as nn
 # source code
 from models.transformer_custom import TransformerEncoder
 from models.transformer_custom import TransformerEncoderLayer
+from models.transformer_custom import GridCache
+from models.transformer_custom import GridContext
 
 # Define the neural network model
 class SimpleEncoder(torch.nn.Module):
@@ -16,7 +18,10 @@ class SimpleEncoder(torch.nn.Module):
                  pos_enc_coeff=2,
                  include_y0_input=False,
                  activation='relu',
-                 dropout=0.1, norm_first=False, dim_feedforward=2048):
+                 dropout=0.1, norm_first=False, dim_feedforward=2048,
+                 attention_chunk_size=None,
+                 quadrature='trapezoid',
+                 attention_kernel='softmax'):
         super(SimpleEncoder, self).__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
@@ -39,6 +44,9 @@ class SimpleEncoder(torch.nn.Module):
             norm_first=norm_first,
             do_layer_norm=do_layer_norm,
             dim_feedforward=dim_feedforward,
+            attention_chunk_size=attention_chunk_size,
+            quadrature=quadrature,
+            attention_kernel=attention_kernel,
             batch_first=True)  # when batch first, expects input tensor (batch_size, Seq_len, input_dim)
         self.encoder = TransformerEncoder(
             encoder_layer, num_layers=num_layers)
@@ -68,17 +76,22 @@ class SimpleEncoder(torch.nn.Module):
         odd_inds = torch.arange(1, self.d_model, 2).unsqueeze(0)
         self.register_buffer('even_inds', even_inds)
         self.register_buffer('odd_inds', odd_inds)
+        # frequency of every column, sin on even and cos on odd columns
+        self.register_buffer('pe_frequencies', 10**(-4 * torch.arange(self.d_model) / self.d_model), persistent=False)
+        self.register_buffer('pe_even_columns', torch.arange(self.d_model) % 2 == 0, persistent=False)
+        # all batches share the same coordinates, so the encoding is only recomputed when the grid changes
+        self.pe_cache = GridCache()
 
     def pe_continuous(self, coords):
         '''generate the positional encoding for coords'''
-        # .to() sends the tensor to the device of the argument
-        pe = torch.zeros(coords.shape[0], self.d_model).to(coords)
-        pe[:, 0::2] = torch.sin(10**self.pos_enc_coeff * coords[:,0] * 10**(-4 * self.even_inds / self.d_model))
-        pe[:, 1::2] = torch.cos(10**self.pos_enc_coeff * coords[:,0] * 10**(-4 * self.odd_inds / self.d_model))
-        for i in range(1, self.domain_dim):
-            pe[:, 0::2] = pe[:, 0::2] * torch.sin(10**self.pos_enc_coeff * coords[:,i] * 10**(-4 * self.even_inds / self.d_model))
-            pe[:, 1::2] = pe[:, 1::2] * torch.cos(10**self.pos_enc_coeff * coords[:,i] * 10**(-4 * self.odd_inds / self.d_model))
-        return pe
+        return self.pe_cache(coords, self.compute_pe_continuous)
+
+    def compute_pe_continuous(self, coords):
+        # coords: (seq_len, domain_dim, 1), angles: (seq_len, domain_dim, d_model)
+        angles = 10**self.pos_enc_coeff * coords[:, :self.domain_dim] * self.pe_frequencies.to(coords)
+        pe = torch.where(self.pe_even_columns, torch.sin(angles), torch.cos(angles))
+        # product over the coordinate dimensions
+        return pe.prod(dim=1)
 
     def positional_encoding(self, x, coords):
         # x: (batch_size, seq_len, input_dim)
@@ -94,8 +107,13 @@ class SimpleEncoder(torch.nn.Module):
 
         return pe
 
-    def apply_positional_encoding(self, x, coords):
-        pe = self.positional_encoding(x, coords)
+    def grid_context(self, x, coords):
+        '''quantities derived from the grid of a batch, computed once and shared by the positional encoding and all encoder layers'''
+        pe = self.positional_encoding(x, coords) if self.use_positional_encoding else None
+        return GridContext(coords, quadrature=self.encoder.quadrature, positional_encoding=pe)
+
+    def apply_positional_encoding(self, x, grid):
+        pe = grid.positional_encoding
         if self.include_y0_input:
             x[:, self.output_dim:, :] += pe
             #'include_y0_input': ['uniform', 'staggered', False],
@@ -139,11 +157,12 @@ class SimpleEncoder(torch.nn.Module):
                 x = self.linear_in(x)  # (batch_size, seq_len, input_dim)
 
         # can use first time because currently all batches share the same time discretization
+        grid = self.grid_context(x, coords_x) # coords_x is "time" for 1D case
         if self.use_positional_encoding:
-            x = self.apply_positional_encoding(x, coords_x) # coords_x is "time" for 1D case
+            x = self.apply_positional_encoding(x, grid)
 
         if self.use_transformer:
-            x = self.encoder(x, coords_x)  # (batch_size, seq_len, dim_state)
+            x = self.encoder(x, grid)  # (batch_size, seq_len, dim_state)
 
         x = self.linear_out(x)  # (seq_len, batch_size, output_dim)
 
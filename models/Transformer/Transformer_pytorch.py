@@ -4,6 +4,8 @@ import torch.nn as nn
 from torch.nn import TransformerEncoder
 from torch.nn import TransformerEncoderLayer
 
+from models.transformer_custom import GridCache
+
 # Define the neural network model
 class SimpleEncoder(torch.nn.Module):
     def __init__(self, input_dim=1, output_dim=1, domain_dim=1, d_model=32, nhead=8, num_layers=6,
@@ -65,17 +67,22 @@ class SimpleEncoder(torch.nn.Module):
         odd_inds = torch.arange(1, self.d_model, 2).unsqueeze(0)
         self.register_buffer('even_inds', even_inds)
         self.register_buffer('odd_inds', odd_inds)
+        # frequency of every column, sin on even and cos on odd columns
+        self.register_buffer('pe_frequencies', 10**(-4 * torch.arange(self.d_model) / self.d_model), persistent=False)
+        self.register_buffer('pe_even_columns', torch.arange(self.d_model) % 2 == 0, persistent=False)
+        # all batches share the same coordinates, so the encoding is only recomputed when the grid changes
+        self.pe_cache = GridCache()
 
     def pe_continuous(self, coords):
         '''generate the positional encoding for coords'''
-        # .to() sends the tensor to the device of the argument
-        pe = torch.zeros(coords.shape[0], self.d_model).to(coords)
-        pe[:, 0::2] = torch.sin(10**self.pos_enc_coeff * coords[:,0] * 10**(-4 * self.even_inds / self.d_model))
-        pe[:, 1::2] = torch.cos(10**self.pos_enc_coeff * coords[:,0] * 10**(-4 * self.odd_inds / self.d_model))
-        for i in range(1, self.domain_dim):
-            pe[:, 0::2] = pe[:, 0::2] * torch.sin(10**self.pos_enc_coeff * coords[:,i] * 10**(-4 * self.even_inds / self.d_model))
-            pe[:, 1::2] = pe[:, 1::2] * torch.cos(10**self.pos_enc_coeff * coords[:,i] * 10**(-4 * self.odd_inds / self.d_model))
-        return pe
+        return self.pe_cache(coords, self.compute_pe_continuous)
+
+    def compute_pe_continuous(self, coords):
+        # coords: (seq_len, domain_dim, 1), angles: (seq_len, domain_dim, d_model)
+        angles = 10**self.pos_enc_coeff * coords[:, :self.domain_dim] * self.pe_frequencies.to(coords)
+        pe = torch.where(self.pe_even_columns, torch.sin(angles), torch.cos(angles))
+        # product over the coordinate dimensions
+        return pe.prod(dim=1)
 
     def positional_encoding(self, x, coords):
         # x: (batch_size, seq_len, input_dim)
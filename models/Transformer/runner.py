@@ -8,6 +8,7 @@ from pytorch_lightning.tuner import Tuner
 
 # Import custom modules
 from datasets import MetaDataModule
+from callbacks import NormMonitor
 from models.Transformer.Transformer_lightning import SimpleEncoderModule
 
 class Runner:
@@ -26,8 +27,20 @@ class Runner:
             T=100,
             train_sample_rate=0.01,
             test_sample_rates=[0.001, 0.01, 0.1],
+            data_cache_dir=None, # directory of the on-disk trajectory cache, None to solve the ODEs on every run
+            generation_workers=1, # processes solving trajectories on a cache miss
+            multirate_test=False, # solve the test trajectories once and share them across test_sample_rates
+            ode_solver='dopri5', # 'dopri5' (adaptive, torchdiffeq) or 'rk4' (batched fixed step)
+            ode_step_size=2.5e-3, # largest step of the 'rk4' solver
             batch_size=32,
             tune_batch_size=False,
+            num_workers=0, # DataLoader worker processes, 0 to load batches in the main process
+            pin_memory=False, # page-locked batches, for faster host to GPU copies
+            persistent_workers=False, # keep the DataLoader workers alive between epochs
+            prefetch_factor=None, # batches loaded in advance by each worker, None for the DataLoader default
+            shuffle=False, # reshuffle the training set every epoch
+            tensor_batching=False, # slice whole batches out of the in-memory datasets instead of collating samples
+            data_device=None, # device where tensor batching keeps the datasets, e.g. 'cuda', None for host memory
             dyn_sys_name='Rossler',
             monitor_metric='loss/val/mse',
             lr_scheduler_params={'patience': 2, 'factor': 0.1},
@@ -49,6 +62,7 @@ class Runner:
             activation='gelu',
             max_epochs=100,
             log_every_n_steps=10,
+            norm_log_every_n_steps=50, # optimizer steps between gradient and parameter norm logs, None to disable them
             gradient_clip_val=10.0,
             gradient_clip_algorithm="value",
             overfit_batches=0.0):
@@ -71,9 +85,21 @@ class Runner:
                                  'test_sample_rates': test_sample_rates,
                                  'batch_size': batch_size,
                                  'tune_batch_size': tune_batch_size,
+                                 'num_workers': num_workers,
+                                 'pin_memory': pin_memory,
+                                 'persistent_workers': persistent_workers,
+                                 'prefetch_factor': prefetch_factor,
+                                 'shuffle': shuffle,
+                                 'tensor_batching': tensor_batching,
+                                 'data_device': data_device,
                                  'dyn_sys_name': dyn_sys_name,
                                  'input_inds': input_inds,
                                  'output_inds': output_inds,
+                                 'cache_dir': data_cache_dir,
+                                 'seed': seed,
+                                 'generation_workers': generation_workers,
+                                 'multirate_test': multirate_test,
+                                 'params': {'method': ode_solver, 'step_size': ode_step_size},
                                  }
 
         self.model_hyperparams = {'input_dim': len(input_inds),
@@ -109,6 +135,7 @@ class Runner:
                                     }
         
         self.other_hyperparams = {'seed': seed, 'tune_initial_lr': tune_initial_lr,
+                                  'norm_log_every_n_steps': norm_log_every_n_steps,
                                   }
 
         self.run()
@@ -143,6 +170,8 @@ class Runner:
 
         # aggregate all callbacks
         callbacks = [lr_monitor, early_stopping]
+        if self.other_hyperparams['norm_log_every_n_steps'] is not None:
+            callbacks.append(NormMonitor(log_every_n_steps=self.other_hyperparams['norm_log_every_n_steps']))
 
 
         # Initialize the trainer
@@ -20,7 +20,8 @@ class SimpleEncoder(torch.nn.Module):
                  smoothing = False,
                  smoothing_modes = None,
                  activation='relu',
-                 dropout=0.1, norm_first=False, dim_feedforward=2048):
+                 dropout=0.1, norm_first=False, dim_feedforward=2048,
+                 attention_memory_budget=None):
         super(SimpleEncoder, self).__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
@@ -50,6 +51,7 @@ class SimpleEncoder(torch.nn.Module):
             patch_size=patch_size,
             modes=modes,
             im_size=im_size,
+            attention_memory_budget=attention_memory_budget,
             batch_first=True)  # when batch first, expects input tensor (batch_size, Seq_len, input_dim)
         self.encoder = TransformerEncoder_Operator(
             encoder_layer, num_layers=num_layers)
@@ -3,58 +3,347 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import copy
+from collections import OrderedDict
+
+
+def trapezoid_weights(coords):
+    '''per-key trapezoidal quadrature weights for a 1D grid of shape (seq_len, 1, 1)'''
+    dx = torch.abs(coords[1:, 0, 0] - coords[:-1, 0, 0])
+    #each interval contributes half its length to both of its endpoints
+    return 0.5*(F.pad(dx, (1, 0)) + F.pad(dx, (0, 1)))
+
+def riemann_weights(coords):
+    '''per-key left Riemann sum weights for a 1D grid of shape (seq_len, 1, 1)'''
+    dx = torch.abs(coords[1:, 0, 0] - coords[:-1, 0, 0])
+    #each interval is assigned to its left endpoint, the last key gets no weight
+    return F.pad(dx, (0, 1))
+
+def simpson_weights(coords):
+    '''per-key composite Simpson weights for a 1D grid of shape (seq_len, 1, 1), spacing may be non-uniform'''
+    dx = torch.abs(coords[1:, 0, 0] - coords[:-1, 0, 0])
+    num_pairs = dx.shape[0] // 2
+    h0, h1 = dx[0:2*num_pairs:2], dx[1:2*num_pairs:2]
+    weights = torch.zeros(dx.shape[0] + 1).to(dx)
+    weights[0:2*num_pairs:2] += (h0 + h1) / 6 * (2 - h1 / h0)
+    weights[1:2*num_pairs:2] += (h0 + h1)**3 / (6 * h0 * h1)
+    weights[2:2*num_pairs+1:2] += (h0 + h1) / 6 * (2 - h0 / h1)
+    #an odd number of intervals leaves the last one to the trapezoid rule
+    if dx.shape[0] % 2:
+        weights[-2:] += 0.5*dx[-1]
+    return weights
+
+QUADRATURE_RULES = {
+    'trapezoid': trapezoid_weights,
+    'riemann': riemann_weights,
+    'simpson': simpson_weights,
+}
+
+
+class GridCache(object):
+    '''
+    Least recently used cache of quantities computed from a coordinate grid, such as quadrature weights or
+    positional encodings. All batches share the same grid, so these only change when the grid does
+    (e.g. a new test sample rate).
+
+    Args:
+        cache_size (int): Number of distinct coordinate grids to keep values for.
+    '''
+    def __init__(self, cache_size=8):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __call__(self, coords, compute):
+        '''
+        Returns compute(coords), reusing the stored value when coords matches a cached grid.
+
+        Args:
+            coords (torch.Tensor): The coordinate grid.
+            compute (callable): Function of coords that produces the cached value.
+        '''
+        # values made under inference mode (e.g. lightning's validation loop) cannot be used by autograd afterwards
+        key = (tuple(coords.shape), coords.dtype, coords.device, torch.is_inference_mode_enabled())
+        if key in self.cache and torch.equal(self.cache[key][0], coords):
+            self.cache.move_to_end(key)
+            return self.cache[key][1]
+
+        value = compute(coords)
+        self.cache[key] = (coords.detach().clone(), value)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+
+class Quadrature(object):
+    '''
+    Per-key quadrature weights for continuum attention, computed once per coordinate grid.
+
+    Args:
+        rule (str or array-like): Name of a rule in QUADRATURE_RULES, or a precomputed vector of weights of shape (seq_len,).
+        cache_size (int): Number of distinct coordinate grids to keep weights for.
+    '''
+    def __init__(self, rule='trapezoid', cache_size=8):
+        if isinstance(rule, str):
+            if rule not in QUADRATURE_RULES:
+                raise ValueError(f"Quadrature rule '{rule}' not found.")
+            self.weights = None
+        else:
+            self.weights = torch.as_tensor(rule, dtype=torch.float)
+        self.rule = rule
+        #non-negative weights can be folded into the scores as log(weights), simpson weights may be negative on non-uniform grids
+        if self.weights is None:
+            self.nonnegative = rule in ('trapezoid', 'riemann')
+        else:
+            self.nonnegative = bool((self.weights >= 0).all())
+        self.cache = GridCache(cache_size)
+
+    def __call__(self, coords):
+        #weights are only defined for 1D grids, coords of shape (seq_len, 1, 1)
+        if coords.shape[1] != 1:
+            return None
+
+        if self.weights is not None:
+            if self.weights.shape[0] != coords.shape[0]:
+                raise ValueError(f"Precomputed quadrature weights have length {self.weights.shape[0]}, but the grid has {coords.shape[0]} points.")
+            self.weights = self.weights.to(coords)
+            return self.weights
+
+        return self.cache(coords, QUADRATURE_RULES[self.rule])
+
+
+def attention_bias(quad_weights, key_padding_mask, dtype):
+    '''
+    Additive score bias for F.scaled_dot_product_attention, softmax(s + log(w)) = w*exp(s) / sum(w*exp(s)).
+
+    Args:
+        quad_weights (torch.Tensor or None): Non-negative per-key quadrature weights of shape (seq_len,).
+        key_padding_mask (torch.Tensor or None): Boolean mask of shape (batch_size, seq_len), True at padded keys.
+        dtype (torch.dtype): dtype of the scores.
+
+    Returns:
+        torch.Tensor or None: Bias of shape (1, seq_len) or (batch_size, 1, 1, seq_len), None if there is nothing to add.
+    '''
+    attn_mask = None
+    if quad_weights is not None:
+        attn_mask = torch.log(quad_weights).to(dtype).unsqueeze(0)
+    if key_padding_mask is not None:
+        padding = torch.zeros(key_padding_mask.shape, dtype=dtype, device=key_padding_mask.device)
+        padding = padding.masked_fill(key_padding_mask, float('-inf')).unsqueeze(1).unsqueeze(2)
+        attn_mask = padding if attn_mask is None else attn_mask + padding
+    return attn_mask
+
+
+class GridContext(object):
+    '''
+    Quantities derived from the coordinate grid of a batch. It is built once and handed to every encoder layer in place
+    of the raw coordinates, so that no layer repeats work that only depends on the grid.
+
+    Args:
+        coords (torch.Tensor): Coordinates of shape (seq_len, domain_dim, 1).
+        quadrature (Quadrature, optional): Rule for the per-key quadrature weights, which are only defined on 1D grids.
+        positional_encoding (torch.Tensor, optional): Positional encoding of the grid, e.g. of shape (seq_len, d_model).
+        key_padding_mask (torch.Tensor, optional): Boolean mask of shape (batch_size, seq_len), True at padded keys.
+    '''
+    def __init__(self, coords, quadrature=None, positional_encoding=None, key_padding_mask=None):
+        self.coords = coords
+        self.quad_weights = None if quadrature is None else quadrature(coords)
+        #non-negative weights can be folded into the scores as log(weights)
+        self.nonnegative = self.quad_weights is None or quadrature.nonnegative
+        self.positional_encoding = positional_encoding
+        self.key_padding_mask = key_padding_mask
+        self.attention_biases = {}
+
+    def attention_bias(self, dtype):
+        '''attention_bias of the grid's quadrature weights and padding mask, computed once per dtype for all layers'''
+        if dtype not in self.attention_biases:
+            self.attention_biases[dtype] = attention_bias(self.quad_weights, self.key_padding_mask, dtype)
+        return self.attention_biases[dtype]
+
+
+def as_grid_context(grid, quadrature=None, **kwargs):
+    '''wraps raw coordinates in a GridContext, so that modules can still be called with coords directly'''
+    if isinstance(grid, GridContext):
+        return grid
+    return GridContext(grid, quadrature=quadrature, **kwargs)
+
+
+def fuse_qkv_state_dict(state_dict, prefix):
+    '''merges the W_q, W_k, W_v entries of checkpoints saved before the fused W_qkv projection, in place'''
+    for param in ('weight', 'bias'):
+        names = [f'{prefix}W_{name}.{param}' for name in ('q', 'k', 'v')]
+        if all(name in state_dict for name in names):
+            state_dict[f'{prefix}W_qkv.{param}'] = torch.cat([state_dict.pop(name) for name in names], dim=0)
 
 
 class ScaledDotProductAttention(nn.Module):
-    def __init__(self, d_k, dropout=0.1):
+    def __init__(self, d_k, dropout=0.1, chunk_size=None, quadrature='trapezoid', use_sdpa=True):
         super(ScaledDotProductAttention, self).__init__()
 
         self.scale = nn.Parameter(torch.sqrt(torch.FloatTensor([d_k])), requires_grad=False)
         self.dropout = nn.Dropout(dropout)
+        #number of keys processed at a time, None materializes the full (batch, nhead, seq_len, seq_len) scores,
+        #only saves memory without autograd since backward keeps the scores of every block
+        self.chunk_size = chunk_size
+        self.quadrature = Quadrature(quadrature)
+        #dispatch to torch's fused scaled_dot_product_attention kernels whenever the quadrature allows it
+        self.use_sdpa = use_sdpa
 
-    def custom_softmax(self, x, coords=None, dim=-1):
+    def custom_softmax(self, x, weights=None, dim=-1):
 
         exp_x = torch.exp(x - x.max(dim=dim, keepdim=True)[0])
         #reweighting of exp_x along seq_len dimension
-        if coords is not None:
-            softmax_x = exp_x / (0.5*coords*(exp_x[...,1:]+exp_x[...,:-1])).sum(dim=dim, keepdim=True)
+        if weights is not None:
+            #a grid with a single point has zero weights, its integral is 0 rather than 0/0
+            normalizer = (weights*exp_x).sum(dim=dim, keepdim=True)
+            softmax_x = exp_x / normalizer.masked_fill(normalizer == 0, 1.)
         else:
             softmax_x = exp_x / exp_x.sum(dim=dim, keepdim=True)
         return softmax_x
 
-    def forward(self, query, key, value, coords, key_padding_mask=None):
+    def chunked_attention(self, query, key, value, weights=None, key_padding_mask=None):
+        '''
+        online softmax over blocks of keys. Without autograd (inference, torch.no_grad) peak memory is linear in
+        seq_len, in training autograd keeps the scores of every block for backward, so memory stays O(seq_len^2)
+        '''
+        batch, nhead, seq_len, _ = query.shape
+        max_score = query.new_full((batch, nhead, seq_len, 1), float('-inf'))
+        normalizer = query.new_zeros(batch, nhead, seq_len, 1)
+        output = query.new_zeros(batch, nhead, seq_len, value.shape[-1])
+
+        for start in range(0, key.shape[-2], self.chunk_size):
+            end = start + self.chunk_size
+            scores = torch.einsum("bhld,bhsd->bhls", query, key[..., start:end, :]) / self.scale
+            if key_padding_mask is not None:
+                scores = scores.masked_fill(key_padding_mask[:, start:end].unsqueeze(1).unsqueeze(2), float('-inf'))
+
+            new_max = torch.maximum(max_score, scores.max(dim=-1, keepdim=True)[0])
+            #rows with every key masked so far keep a finite reference so that exp does not produce nan
+            safe_max = new_max.masked_fill(torch.isinf(new_max), 0.)
+            rescale = torch.exp(max_score - safe_max)
+            exp_scores = torch.exp(scores - safe_max)
+            #reweighting of exp_scores along seq_len dimension, shared by the normalizer and the values
+            if weights is not None:
+                exp_scores = exp_scores * weights[start:end]
+
+            normalizer = normalizer * rescale + exp_scores.sum(dim=-1, keepdim=True)
+            output = output * rescale + torch.einsum("bhls,bhsd->bhld", self.dropout(exp_scores), value[..., start:end, :])
+            max_score = new_max
+
+        #zero quadrature weights (a single point grid) give a zero output, as the unchunked paths do
+        if weights is not None:
+            normalizer = normalizer.masked_fill(normalizer == 0, 1.)
+        return output / normalizer
+
+    def fused_attention(self, query, key, value, grid, key_padding_mask=None):
+        '''
+        continuum attention through F.scaled_dot_product_attention: softmax(s + log(w)) = w*exp(s) / sum(w*exp(s)),
+        so non-negative quadrature weights become an additive bias on the scores. On a uniform trapezoid grid the bias
+        is a constant, which cancels, plus -log(2) on the two endpoint keys.
+        '''
+        if key_padding_mask is grid.key_padding_mask:
+            attn_mask = grid.attention_bias(query.dtype)
+        else:
+            attn_mask = attention_bias(grid.quad_weights, key_padding_mask, query.dtype)
+
+        #the default scale of scaled_dot_product_attention is 1/sqrt(d_k), the same as self.scale
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                              dropout_p=self.dropout.p if self.training else 0.)
+
+    def forward(self, query, key, value, grid, key_padding_mask=None):
         # Custom logic for attention calculation
 
-        scores = torch.einsum("bhld,bhsd->bhls", query, key) / self.scale
+        #grid is a GridContext, raw coordinates are wrapped with this module's quadrature rule
+        grid = as_grid_context(grid, self.quadrature)
+        if key_padding_mask is None:
+            key_padding_mask = grid.key_padding_mask
+        #quad_weights is a vector of per-key weights of shape (seq_len,), broadcastable with scores, None if domain_dim is not 1
+        quad_weights = grid.quad_weights
 
-        #makes sure that if domain_dim is not 1, then coords is handled differently
-        if coords.shape[1]==1:
-            coords = torch.abs(coords[1:,...] - coords[:-1,...])
-            coords = coords.permute(1,2,0).unsqueeze(0)
-            #coords is now a vector of distances between coordinates such that the shape is broadcastable with scores[...,1:] (1,1,1,seq_len-1)
-        else:
-            coords = None
+        if self.chunk_size is not None:
+            return self.chunked_attention(query, key, value, weights=quad_weights, key_padding_mask=key_padding_mask)
+
+        if self.use_sdpa and grid.nonnegative:
+            return self.fused_attention(query, key, value, grid, key_padding_mask=key_padding_mask)
+
+        scores = torch.einsum("bhld,bhsd->bhls", query, key) / self.scale
 
         if key_padding_mask is not None:
             scores = scores.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
 
-        attention_weights = self.custom_softmax(scores, coords=coords, dim=-1)
+        attention_weights = self.custom_softmax(scores, weights=quad_weights, dim=-1)
         attention_weights = self.dropout(attention_weights)
 
-        #reweighting of value along seq_len dimension
-        if coords is not None:
-            value1 = coords.permute(0,1,3,2)*value[...,1:,:]
-            output1 = torch.einsum("bhls,bhsd->bhld", attention_weights[...,1:], value1)
-            value2 = coords.permute(0,1,3,2)*value[...,:-1,:]
-            output2 = torch.einsum("bhls,bhsd->bhld", attention_weights[...,:-1], value2)
-            output = 0.5*(output1 + output2)
+        #reweighting of value along seq_len dimension, a single matmul replaces the two trapezoid sums
+        if quad_weights is not None:
+            value = quad_weights.unsqueeze(-1)*value
+        output = torch.einsum("bhls,bhsd->bhld", attention_weights, value)
+
+        return output
+
+class KernelizedAttention(nn.Module):
+    '''
+    Continuum attention with the exponential kernel replaced by a positive feature map, exp(q.k/scale) ~ phi(q).phi(k),
+    so that cost and memory are linear in seq_len. The quadrature weights multiply the key features, so the output is
+    still a discretization of the same integral over the domain.
+
+    Args:
+        d_k (int): Dimension of each head.
+        dropout (float): Unused, attention dropout needs the full attention matrix which is never formed.
+        feature_map (str): 'elu' for elu(x)+1 features, 'random' for positive random features approximating softmax.
+        num_features (int): Number of random features, defaults to 4*d_k.
+        quadrature (str or array-like): Quadrature rule, see Quadrature.
+    '''
+    def __init__(self, d_k, dropout=0.1, feature_map='elu', num_features=None, quadrature='trapezoid'):
+        super(KernelizedAttention, self).__init__()
+
+        self.scale = nn.Parameter(torch.sqrt(torch.FloatTensor([d_k])), requires_grad=False)
+        self.feature_map = feature_map
+        self.quadrature = Quadrature(quadrature)
+
+        if feature_map == 'random':
+            num_features = 4*d_k if num_features is None else num_features
+            self.register_buffer('projection', torch.randn(num_features, d_k))
+        elif feature_map != 'elu':
+            raise ValueError(f"Feature map '{feature_map}' not found.")
+
+    def features(self, x, is_query):
+        if self.feature_map == 'elu':
+            return F.elu(x) + 1
+
+        #positive random features, E[phi(q).phi(k)] = exp(q.k/scale)
+        x = x / torch.sqrt(self.scale)
+        projection = torch.einsum("bhld,md->bhlm", x, self.projection)
+        projection = projection - 0.5*(x**2).sum(dim=-1, keepdim=True)
+        #subtracting a max keeps exp finite, per query row or over all keys, it cancels in the normalization
+        if is_query:
+            stabilizer = projection.max(dim=-1, keepdim=True)[0]
         else:
-            output = torch.einsum("bhls,bhsd->bhld", attention_weights, value)
+            stabilizer = projection.amax(dim=(-2, -1), keepdim=True)
+        return torch.exp(projection - stabilizer.detach()) / math.sqrt(self.projection.shape[0])
+
+    def forward(self, query, key, value, grid, key_padding_mask=None):
+
+        grid = as_grid_context(grid, self.quadrature)
+        if key_padding_mask is None:
+            key_padding_mask = grid.key_padding_mask
+        quad_weights = grid.quad_weights
+
+        query = self.features(query, is_query=True)
+        key = self.features(key, is_query=False)
+
+        if key_padding_mask is not None:
+            key = key.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(-1), 0.)
+        #reweighting of key features along seq_len dimension
+        if quad_weights is not None:
+            key = quad_weights.unsqueeze(-1)*key
+
+        key_value = torch.einsum("bhsm,bhsd->bhmd", key, value)
+        normalizer = torch.einsum("bhlm,bhm->bhl", query, key.sum(dim=-2)).unsqueeze(-1)
+        output = torch.einsum("bhlm,bhmd->bhld", query, key_value) / normalizer
 
         return output
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model, nhead, dropout=0.1):
+    def __init__(self, d_model, nhead, dropout=0.1, chunk_size=None, quadrature='trapezoid', attention_kernel='softmax'):
         super(MultiHeadAttention, self).__init__()
         assert d_model % nhead == 0, "d_model must be divisible by nhead"
 
@@ -62,29 +351,35 @@ class MultiHeadAttention(nn.Module):
         self.nhead = nhead
         self.d_k = d_model // nhead
 
-        self.W_q = nn.Linear(d_model, nhead*self.d_k)
-        self.W_k = nn.Linear(d_model, nhead*self.d_k)
-        self.W_v = nn.Linear(d_model, nhead*self.d_k)
-        self.scaled_dot_product_attention = ScaledDotProductAttention(self.d_k, dropout=dropout)
+        #query, key and value projections in a single GEMM, rows ordered as (q, k, v) x (nhead, d_k)
+        self.W_qkv = nn.Linear(d_model, 3*nhead*self.d_k)
+        if attention_kernel == 'softmax':
+            self.scaled_dot_product_attention = ScaledDotProductAttention(self.d_k, dropout=dropout, chunk_size=chunk_size, quadrature=quadrature)
+        else:
+            self.scaled_dot_product_attention = KernelizedAttention(self.d_k, dropout=dropout, feature_map=attention_kernel, quadrature=quadrature)
         self.W_o = nn.Linear(nhead*self.d_k, d_model)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_qkv_state_dict(state_dict, prefix)
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def split_heads(self, x):
-        #batch_size, seq_length, d_model = x.size()
+        #batch_size, seq_length, 3*d_model = x.size()
         batch_size = x.shape[0]
-        return x.view(batch_size, -1, self.nhead, self.d_k).transpose(1, 2)
+        #head-major (batch_size, nhead, seq_length, d_k) views of query, key and value, no copies
+        return x.view(batch_size, -1, 3, self.nhead, self.d_k).permute(2, 0, 3, 1, 4).unbind(0)
 
     def combine_heads(self, x):
         #batch_size, nhead, seq_length, d_k = x.size()
         batch_size = x.shape[0]
-        return x.transpose(1, 2).contiguous().view(batch_size, -1, self.nhead * self.d_k)
+        #only copies if the attention backend did not already return a (batch_size, seq_length, nhead, d_k) layout
+        return x.transpose(1, 2).reshape(batch_size, -1, self.nhead * self.d_k)
 
-    def forward(self, x, coords_x, mask=None):
+    def forward(self, x, grid, mask=None):
 
-        Q = self.split_heads(self.W_q(x))
-        K = self.split_heads(self.W_k(x))
-        V = self.split_heads(self.W_v(x))
+        Q, K, V = self.split_heads(self.W_qkv(x))
 
-        attn_output = self.scaled_dot_product_attention(Q, K, V, coords_x, mask)
+        attn_output = self.scaled_dot_product_attention(Q, K, V, grid, mask)
         output = self.W_o(self.combine_heads(attn_output))
         return output
 
@@ -101,16 +396,19 @@ class FeedForward(nn.Module):
 
 
 class TransformerEncoderLayer(nn.Module):
-    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, batch_first=True):
+    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, batch_first=True,
+                 attention_chunk_size=None, quadrature='trapezoid', attention_kernel='softmax'):
         super(TransformerEncoderLayer, self).__init__()
-        self.self_attn = MultiHeadAttention(d_model, nhead)
+        self.self_attn = MultiHeadAttention(d_model, nhead, chunk_size=attention_chunk_size, quadrature=quadrature,
+                                            attention_kernel=attention_kernel)
+        self.quadrature = self.self_attn.scaled_dot_product_attention.quadrature
         self.feed_forward = FeedForward(d_model, dim_feedforward, activation)
         self.norm1 = nn.LayerNorm(d_model)
         self.norm2 = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, coords_x, mask=None):
-        attn_output = self.self_attn(x, coords_x)
+    def forward(self, x, grid, mask=None):
+        attn_output = self.self_attn(x, grid)
         x = self.norm1(x + self.dropout(attn_output))
         ff_output = self.feed_forward(x)
         x = self.norm2(x + self.dropout(ff_output))
@@ -121,10 +419,13 @@ class TransformerEncoder(nn.Module):
     def __init__(self, encoder_layer, num_layers=1):
         super(TransformerEncoder, self).__init__()
         self.layers = nn.ModuleList([copy.deepcopy(encoder_layer) for _ in range(num_layers)])
+        self.quadrature = self.layers[0].quadrature
 
-    def forward(self, x, coords_x, mask=None):
+    def forward(self, x, grid, mask=None):
+        #everything that depends only on the grid is computed once and shared by all layers
+        grid = as_grid_context(grid, self.quadrature, key_padding_mask=mask)
         for layer in self.layers:
-            x = layer(x, coords_x, mask=mask)
+            x = layer(x, grid, mask=mask)
         return x
 
 ###############################################################################################################
@@ -133,45 +434,187 @@ class TransformerEncoder(nn.Module):
 ###############################################################################################################
 ###############################################################################################################
 
+def spectrum_buffer(cache, shape, device, cache_size=4):
+    '''
+    Returns a zero complex spectrum of the given shape that is reused across forward calls.
+    Spectral layers only ever write their retained modes into it, so everything else stays zero
+    and no zero fill is needed per call.
+
+    Args:
+        cache (OrderedDict): Per-module store of buffers, keyed by shape, device and inference mode.
+        shape (tuple): Shape of the output spectrum.
+        device (torch.device): Device of the output spectrum.
+        cache_size (int): Number of distinct shapes to keep buffers for (e.g. full and last partial batch).
+
+    Returns:
+        torch.Tensor: The buffer, detached so that every call starts a fresh autograd history.
+    '''
+    # buffers made under inference mode cannot be used by autograd afterwards
+    key = (tuple(shape), device, torch.is_inference_mode_enabled())
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = torch.zeros(shape, dtype=torch.cfloat, device=device)
+        if len(cache) > cache_size:
+            cache.popitem(last=False)
+    # the inverse fft does not save its input for backward, so the buffer can be overwritten by the next call
+    return cache[key].detach()
+
+
+def stack_spectral_weights(weights1, weights2):
+    '''
+    Stacks the complex weights of the two retained frequency bands into one real tensor laid out for a batched
+    matrix multiply over modes.
+
+    Args:
+        weights1, weights2 (torch.Tensor): Complex weights of shape (in_channels, out_channels, modes1, modes2, ...)
+            for the first and last modes1 rows of the spectrum.
+
+    Returns:
+        torch.Tensor: Real tensor of shape (2*modes1*modes2, in_channels, out_channels*..., 2).
+    '''
+    # (in_channels, out_channels, band, modes1, modes2, ...) -> (band, modes1, modes2, in_channels, out_channels, ...)
+    weights = torch.stack((weights1, weights2), dim=2).movedim((0, 1), (3, 4))
+    weights = weights.reshape(-1, weights.shape[3], weights.shape[4:].numel())
+    return torch.view_as_real(weights).contiguous()
+
+
+def spectral_weights_state_dict(state_dict, prefix):
+    '''stacks the weights1, weights2 entries of checkpoints saved before the stacked spectral weights, in place'''
+    names = [f'{prefix}weights1', f'{prefix}weights2']
+    if all(name in state_dict for name in names):
+        weights1, weights2 = [state_dict.pop(name) for name in names]
+        if not weights1.is_complex():
+            weights1, weights2 = torch.view_as_complex(weights1), torch.view_as_complex(weights2)
+        state_dict[f'{prefix}weights'] = stack_spectral_weights(weights1, weights2)
+
+
+def spectral_mul(x_low, x_high, weights):
+    '''
+    Multiplies every retained Fourier mode by its (in_channels, out_channels) complex weight matrix.
+    The modes of both frequency bands are contracted together in one batched matrix multiply over modes.
+    For batches that are small next to in_channels this is the real product [x.real; x.imag] @ [w.real, w.imag],
+    otherwise a complex one, whichever was faster on cpu in benchmark_scripts/spectral_benchmark.py.
+
+    Args:
+        x_low, x_high (torch.Tensor): Complex tensors of shape (batch, in_channels, modes1, modes2), the first
+            and last modes1 rows of the spectrum. Slices of the full spectrum can be passed as they are.
+        weights (torch.Tensor): Real tensor of shape (2*modes1*modes2, in_channels, out_channels, 2), see stack_spectral_weights.
+
+    Returns:
+        torch.Tensor: Complex tensor of shape (batch, out_channels, 2*modes1, modes2).
+    '''
+    batchsize, in_channels, modes1, modes2 = x_low.shape
+    # both bands laid out as (modes, batch, in_channels) with a single copy
+    x = torch.cat((x_low.permute(2, 3, 0, 1), x_high.permute(2, 3, 0, 1))).flatten(0, 1)
+
+    if in_channels == 1:
+        # a matrix multiply per mode with a single input channel is all overhead
+        out = x * torch.view_as_complex(weights)
+    elif batchsize > 2*in_channels:
+        # the extra passes over the batch needed by the real product cost more than the complex gemm saves
+        out = torch.bmm(x, torch.view_as_complex(weights))
+    else:
+        # (modes, real and imaginary parts of the batch, in_channels) @ (modes, in_channels, out_channels interleaved with re/im)
+        out = torch.bmm(torch.cat((x.real, x.imag), dim=1), weights.flatten(-2)).view(x.shape[0], 2, batchsize, -1, 2)
+        out = torch.complex(out[:, 0, :, :, 0] - out[:, 1, :, :, 1], out[:, 0, :, :, 1] + out[:, 1, :, :, 0])
+    return out.view(2*modes1, modes2, batchsize, -1).permute(2, 3, 0, 1)
+
 
 class SpectralConv2d(nn.Module):
 
-    def __init__(self, in_channels, out_channels, modes1, modes2):
+    def __init__(self, in_channels, out_channels, modes1, modes2, *, inverse_transform='auto'):
         super(SpectralConv2d, self).__init__()
         """
         2D Fourier layer. It does FFT, linear transform, and Inverse FFT.
         """
+        if inverse_transform not in ('auto', 'fft', 'dft'):
+            raise ValueError(f"inverse_transform must be 'auto', 'fft' or 'dft', got {inverse_transform}")
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.modes1 = modes1 #Number of Fourier modes to multiply, at most floor(N/2) + 1
         self.modes2 = modes2
+        #'fft' inverts only the retained columns with ffts, 'dft' uses partial dft matrices over the retained modes
+        self.inverse_transform = inverse_transform
         self.scale = (1 / (in_channels * out_channels))
-        #use torch.view_as_real if using ddp
-        #self.weights1 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        #self.weights2 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        self.weights1 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        self.weights2 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
+        #weights of both frequency bands stacked as real numbers (which also works with ddp), see stack_spectral_weights
+        weights1 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        weights2 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        self.weights = nn.Parameter(stack_spectral_weights(weights1, weights2))
+        self.out_ft_cache = OrderedDict()
+        self.dft_cache = OrderedDict()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        spectral_weights_state_dict(state_dict, prefix)
+        super(SpectralConv2d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     # Complex multiplication
-    def compl_mul2d(self, input, weights):
-        # (batch, in_channel, x,y ), (in_channel, out_channel, x,y) -> (batch, out_channel, x,y)
-        return torch.einsum("bixy,ioxy->boxy", input, weights)
+    def compl_mul2d(self, input_low, input_high):
+        # 2 x (batch, in_channel, modes1, modes2) -> (batch, out_channel, 2*modes1, modes2), both bands at once
+        return spectral_mul(input_low, input_high, self.weights)
+
+    def use_dft(self, rows, cols):
+        # rough multiply-add counts of the partial dft against the pruned inverse fft, dominated by the column stage
+        if self.inverse_transform != 'auto':
+            return self.inverse_transform == 'dft'
+        dft_cost = 2*rows*cols*self.modes2 + 8*rows*self.modes1*self.modes2
+        fft_cost = 2.5*rows*cols*math.log2(cols) + 5*self.modes2*rows*math.log2(rows)
+        return dft_cost < fft_cost
+
+    def dft_matrices(self, rows, cols, device):
+        '''
+        Partial inverse dft matrices restricted to the retained modes, cached per grid size.
+
+        Returns:
+            tuple: (rows, 2*modes1) complex matrix for the retained rows, and the real and imaginary
+                (modes2, cols) matrices of the inverse real transform over the retained columns.
+        '''
+        # matrices made under inference mode cannot be saved for backward by autograd afterwards
+        key = (rows, cols, device, torch.is_inference_mode_enabled())
+        if key in self.dft_cache:
+            self.dft_cache.move_to_end(key)
+            return self.dft_cache[key]
+
+        # row frequencies in the order out_ft stores them: the first modes1, then the last modes1
+        k1 = torch.cat((torch.arange(self.modes1), torch.arange(rows - self.modes1, rows))).double()
+        row_dft = torch.exp(2j * math.pi * torch.outer(torch.arange(rows).double(), k1) / rows) / rows
+        # irfft counts every column twice except the zero (and Nyquist) frequency, whose imaginary part it drops
+        k2 = torch.arange(self.modes2).double()
+        angle = 2 * math.pi * torch.outer(k2, torch.arange(cols).double()) / cols
+        counts = torch.full((self.modes2, 1), 2., dtype=torch.float64)
+        counts[0] = 1.
+        if cols % 2 == 0 and self.modes2 == cols//2 + 1:
+            counts[-1] = 1.
+        col_cos = counts * torch.cos(angle) / cols
+        col_sin = -counts * torch.sin(angle) / cols
+
+        matrices = (row_dft.to(device=device, dtype=torch.cfloat),
+                    col_cos.to(device=device, dtype=torch.float32),
+                    col_sin.to(device=device, dtype=torch.float32))
+        self.dft_cache[key] = matrices
+        if len(self.dft_cache) > 4:
+            self.dft_cache.popitem(last=False)
+        return matrices
+
     def forward(self, x):
         batchsize = x.shape[0]
+        rows, cols = x.size(-2), x.size(-1)
         #Compute Fourier coeffcients up to factor of e^(- something constant)
         x_ft = torch.fft.rfft2(x)
-        # Multiply relevant Fourier modes
-        out_ft = torch.zeros(batchsize, self.out_channels,  x.size(-2), x.size(-1)//2 + 1, dtype=torch.cfloat, device=x.device)
-        #use torch.view_as_complex if using ddp
-        #out_ft[:, :, :self.modes1, :self.modes2] = \
-        #    self.compl_mul2d(x_ft[:, :, :self.modes1, :self.modes2], torch.view_as_complex(self.weights1))
-        #out_ft[:, :, -self.modes1:, :self.modes2] = \
-        #    self.compl_mul2d(x_ft[:, :, -self.modes1:, :self.modes2], torch.view_as_complex(self.weights2))
-        out_ft[:, :, :self.modes1, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :, :self.modes1, :self.modes2], self.weights1)
-        out_ft[:, :, -self.modes1:, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :, -self.modes1:, :self.modes2], self.weights2)
-        #Return to physical space
-        x = torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)))
+        # Multiply relevant Fourier modes, the first and last modes1 rows
+        out_modes = self.compl_mul2d(x_ft[:, :, :self.modes1, :self.modes2], x_ft[:, :, -self.modes1:, :self.modes2])
+
+        #Return to physical space, only the retained modes are transformed since the rest of the spectrum is zero
+        if 2*self.modes1 <= rows and self.use_dft(rows, cols):
+            row_dft, col_cos, col_sin = self.dft_matrices(rows, cols, x.device)
+            out_ft = row_dft @ out_modes
+            x = out_ft.real @ col_cos + out_ft.imag @ col_sin
+        else:
+            # inverse fft over the rows of the retained columns, then a real inverse fft that zero pads the columns
+            out_ft = spectrum_buffer(self.out_ft_cache, (batchsize, self.out_channels, rows, self.modes2), x.device)
+            out_ft[:, :, :self.modes1] = out_modes[:, :, :self.modes1]
+            out_ft[:, :, -self.modes1:] = out_modes[:, :, self.modes1:]
+            x = torch.fft.irfft(torch.fft.ifft(out_ft, dim=-2), n=cols)
         return x
 
 
@@ -181,17 +624,65 @@ class SpectralConv2d(nn.Module):
 ###############################################################################################################
 ###############################################################################################################
 
+def chunked_patch_attention(query, key, value, scale, dropout, key_padding_mask=None, memory_budget=None):
+    '''
+    Attention between patches of functions computed over blocks of query and key patches with an online softmax,
+    so that only block-sized copies of query, key and value are alive at any time.
+
+    Args:
+        query, key, value (torch.Tensor): Tensors of shape (batch, nhead, num_patches, x, y, d).
+        scale (torch.Tensor): Scores are divided by scale.
+        dropout (nn.Dropout): Dropout applied to the attention weights.
+        key_padding_mask (torch.Tensor): Boolean mask of shape (batch, num_patches), True for patches to ignore.
+        memory_budget (int): Bytes of block temporaries allowed per step, sets the number of patches per block.
+
+    Returns:
+        torch.Tensor: Output of shape (batch, num_patches, x, y, d, nhead).
+    '''
+    batch, nhead, num_patches = query.shape[:3]
+    patch_numel = batch * nhead * query[0, 0, 0].numel() * query.element_size()
+    #query, key and value blocks, the output accumulator and its rescaled copy
+    block = max(1, min(num_patches, memory_budget // (5 * patch_numel)))
+
+    output = query.new_empty(batch, num_patches, *value.shape[3:], nhead)
+    for q_start in range(0, num_patches, block):
+        query_block = query[:, :, q_start:q_start+block]
+        max_score = query.new_full((*query_block.shape[:3], 1), float('-inf'))
+        normalizer = query.new_zeros(*query_block.shape[:3], 1)
+        accumulator = query.new_zeros(*query_block.shape[:3], *value.shape[3:])
+
+        for k_start in range(0, num_patches, block):
+            scores = torch.einsum("bnpxyd,bnqxyd->bnpq", query_block, key[:, :, k_start:k_start+block]) / scale
+            if key_padding_mask is not None:
+                scores = scores.masked_fill(key_padding_mask[:, k_start:k_start+block].unsqueeze(1).unsqueeze(2), float('-inf'))
+
+            new_max = torch.maximum(max_score, scores.max(dim=-1, keepdim=True)[0])
+            #rows with every key masked so far keep a finite reference so that exp does not produce nan
+            safe_max = new_max.masked_fill(torch.isinf(new_max), 0.)
+            rescale = torch.exp(max_score - safe_max)
+            exp_scores = torch.exp(scores - safe_max)
+
+            normalizer = normalizer * rescale + exp_scores.sum(dim=-1, keepdim=True)
+            accumulator = accumulator * rescale[..., None, None] + torch.einsum("bnpq,bnqxyd->bnpxyd", dropout(exp_scores), value[:, :, k_start:k_start+block])
+            max_score = new_max
+
+        output[:, q_start:q_start+block] = (accumulator / normalizer[..., None, None]).permute(0,2,3,4,5,1)
+
+    return output
+
+
 
 class MultiheadAttention_Operator(nn.Module):
-    def __init__(self, d_model, nhead, modes1, modes2, im_size, dropout=0.1):
+    def __init__(self, d_model, nhead, modes1, modes2, im_size, dropout=0.1, memory_budget=None):
         super(MultiheadAttention_Operator, self).__init__()
         self.nhead = nhead
 
-        self.query_operator = SpectralConv2d(d_model, d_model, modes1, modes2, nhead)
-        self.key_operator = SpectralConv2d(d_model, d_model, modes1, modes2, nhead)
-        self.value_operator = SpectralConv2d(d_model, d_model, modes1, modes2, nhead)
+        #one d_model operator per head, outputs of shape (batch, num_patches, x, y, d_model, nhead)
+        self.query_operator = SpectralConv2d_Attention(d_model, d_model, modes1, modes2, nhead)
+        self.key_operator = SpectralConv2d_Attention(d_model, d_model, modes1, modes2, nhead)
+        self.value_operator = SpectralConv2d_Attention(d_model, d_model, modes1, modes2, nhead)
 
-        self.scaled_dot_product_attention = ScaledDotProductAttention_Operator(d_model, im_size, dropout=dropout)
+        self.scaled_dot_product_attention = ScaledDotProductAttention_Operator(d_model, im_size, dropout=dropout, memory_budget=memory_budget)
 
         self.out_linear = nn.Linear(d_model*nhead, d_model)
         self.dropout = nn.Dropout(dropout)
@@ -215,14 +706,19 @@ class MultiheadAttention_Operator(nn.Module):
         return output
 
 class ScaledDotProductAttention_Operator(nn.Module):
-    def __init__(self, d_model, im_size, dropout=0.1):
+    def __init__(self, d_model, im_size, dropout=0.1, memory_budget=None):
         super(ScaledDotProductAttention_Operator, self).__init__()
         #d_model* or just d_model?
         self.scale = nn.Parameter(torch.sqrt(torch.FloatTensor([((im_size)**4)])), requires_grad=False)
         self.dropout = nn.Dropout(dropout)
+        #bytes of block temporaries allowed in attention, None computes all patches at once
+        self.memory_budget = memory_budget
 
     def forward(self, query, key, value, key_padding_mask=None):
         # Custom logic for attention calculation
+        if self.memory_budget is not None:
+            return chunked_patch_attention(query, key, value, self.scale, self.dropout, key_padding_mask, self.memory_budget), None
+
         scores = torch.einsum("bnpxyd,bnqxyd->bnpq", query, key) / self.scale
 
         if key_padding_mask is not None:
@@ -237,7 +733,8 @@ class ScaledDotProductAttention_Operator(nn.Module):
         return output, attention_weights
 
 class TransformerEncoderLayer_Operator(nn.Module):#
-    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True):
+    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True,
+                 attention_memory_budget=None):
         super(TransformerEncoderLayer_Operator, self).__init__()
 
         # Self-attention layer
@@ -248,7 +745,7 @@ class TransformerEncoderLayer_Operator(nn.Module):#
             modes1 = modes[0]
             modes2 = modes[1]
         #or im_size?
-        self.self_attn = MultiheadAttention_Operator(d_model, nhead, modes1, modes2, im_size, dropout=dropout)
+        self.self_attn = MultiheadAttention_Operator(d_model, nhead, modes1, modes2, im_size, dropout=dropout, memory_budget=attention_memory_budget)
 
         # Feedforward layer
         self.linear1 = nn.Linear(d_model, dim_feedforward)
@@ -325,16 +822,21 @@ class SpectralConv2d_in(nn.Module):
         self.modes2 = modes2
 
         self.scale = (1 / (in_channels * out_channels))
-        #use torch.view_as_real if using ddp
-        #self.weights1 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        #self.weights2 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        self.weights1 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
-        self.weights2 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat)))
+        #weights of both frequency bands stacked as real numbers (which also works with ddp), see stack_spectral_weights
+        weights1 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        weights2 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        self.weights = nn.Parameter(stack_spectral_weights(weights1, weights2))
+        self.out_ft_cache = OrderedDict()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        spectral_weights_state_dict(state_dict, prefix)
+        super(SpectralConv2d_in, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     # Complex multiplication
-    def compl_mul2d(self, input, weights):
-        # (batch,num_patches, in_channel, x,y ), (in_channel, out_channel, x,y) -> (batch, num_patches, out_channel, x,y)
-        return torch.einsum("bnixy,ioxy->bnoxy", input, weights)
+    def compl_mul2d(self, input_low, input_high):
+        # 2 x (batch,num_patches, in_channel, modes1, modes2) -> (batch, num_patches, out_channel, 2*modes1, modes2), both bands at once
+        out = spectral_mul(input_low.flatten(0, 1), input_high.flatten(0, 1), self.weights)
+        return out.unflatten(0, input_low.shape[:2])
 
     def forward(self, x):
         batchsize = x.shape[0]
@@ -343,16 +845,10 @@ class SpectralConv2d_in(nn.Module):
         x_ft = torch.fft.rfft2(x)
 
         # Multiply relevant Fourier modes
-        out_ft = torch.zeros(batchsize, num_patches, self.out_channels,  x.size(-2), x.size(-1)//2 + 1, dtype=torch.cfloat, device=x.device)
-        #use torch.view_as_complex if using ddp
-        #out_ft[:,:, :, :self.modes1, :self.modes2] = \
-            #self.compl_mul2d(x_ft[:, :,:, :self.modes1, :self.modes2], torch.view_as_complex(self.weights1))
-        #out_ft[:,:, :, -self.modes1:, :self.modes2] = \
-            #self.compl_mul2d(x_ft[:, :,:, -self.modes1:, :self.modes2], torch.view_as_complex(self.weights2))
-        out_ft[:,:, :, :self.modes1, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :,:, :self.modes1, :self.modes2], self.weights1)
-        out_ft[:,:, :, -self.modes1:, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :,:, -self.modes1:, :self.modes2], self.weights2)
+        out_ft = spectrum_buffer(self.out_ft_cache, (batchsize, num_patches, self.out_channels,  x.size(-2), x.size(-1)//2 + 1), x.device)
+        out_modes = self.compl_mul2d(x_ft[:, :,:, :self.modes1, :self.modes2], x_ft[:, :,:, -self.modes1:, :self.modes2])
+        out_ft[:,:, :, :self.modes1, :self.modes2] = out_modes[:,:, :, :self.modes1]
+        out_ft[:,:, :, -self.modes1:, :self.modes2] = out_modes[:,:, :, self.modes1:]
 
         #Return to physical space
         x = torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)))
@@ -360,7 +856,7 @@ class SpectralConv2d_in(nn.Module):
 
 
 class MultiheadAttention_ViTNO(nn.Module):
-    def __init__(self, d_model, nhead, im_size, dropout=0.1):
+    def __init__(self, d_model, nhead, im_size, dropout=0.1, memory_budget=None):
         super(MultiheadAttention_ViTNO, self).__init__()
         assert d_model % nhead == 0, "d_model must be divisible by nhead"
 
@@ -368,15 +864,19 @@ class MultiheadAttention_ViTNO(nn.Module):
         self.nhead = nhead
         self.d_k = d_model // nhead
 
-        self.W_q = nn.Linear(d_model, nhead*self.d_k)
-        self.W_k = nn.Linear(d_model, nhead*self.d_k)
-        self.W_v = nn.Linear(d_model, nhead*self.d_k)
-        self.scaled_dot_product_attention = ScaledDotProductAttention_ViTNO(self.d_k, im_size, dropout=dropout)
+        #query, key and value projections in a single GEMM, rows ordered as (q, k, v) x (d_k, nhead)
+        self.W_qkv = nn.Linear(d_model, 3*nhead*self.d_k)
+        self.scaled_dot_product_attention = ScaledDotProductAttention_ViTNO(self.d_k, im_size, dropout=dropout, memory_budget=memory_budget)
         self.W_o = nn.Linear(nhead*self.d_k, d_model)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_qkv_state_dict(state_dict, prefix)
+        super(MultiheadAttention_ViTNO, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def split_heads(self, x):
-        batch, num_patches, patch_size, patch_size, nhead_times_d_K = x.size()
-        return x.view(batch, num_patches, patch_size, patch_size, self.d_k, self.nhead).permute(0,5,1,2,3,4)
+        batch, num_patches, patch_size, patch_size, three_nhead_times_d_K = x.size()
+        #head-major (batch, nhead, num_patches, x, y, d_K) views of query, key and value, no copies
+        return x.view(batch, num_patches, patch_size, patch_size, 3, self.d_k, self.nhead).permute(4,0,6,1,2,3,5).unbind(0)
 
     def combine_heads(self, x):
         batch, num_patches, patch_size, patch_size, d_K, num_heads = x.size()
@@ -384,9 +884,7 @@ class MultiheadAttention_ViTNO(nn.Module):
 
     def forward(self, x, key_padding_mask=None):
 
-        Q = self.split_heads(self.W_q(x))
-        K = self.split_heads(self.W_k(x))
-        V = self.split_heads(self.W_v(x))
+        Q, K, V = self.split_heads(self.W_qkv(x))
         # query, key, and value are of shape (batch, nhead, num_patches,x,y , d_K)
 
         attn_output = self.scaled_dot_product_attention(Q, K, V, key_padding_mask)
@@ -394,14 +892,19 @@ class MultiheadAttention_ViTNO(nn.Module):
         return output
 
 class ScaledDotProductAttention_ViTNO(nn.Module):
-    def __init__(self, d_k, im_size, dropout=0.1):
+    def __init__(self, d_k, im_size, dropout=0.1, memory_budget=None):
         super(ScaledDotProductAttention_ViTNO, self).__init__()
         #d_K* or just d_K?
         self.scale = nn.Parameter(torch.sqrt(torch.FloatTensor([((im_size)**4)])), requires_grad=False)
         self.dropout = nn.Dropout(dropout)
+        #bytes of block temporaries allowed in attention, None computes all patches at once
+        self.memory_budget = memory_budget
 
     def forward(self, query, key, value, key_padding_mask=None):
         # Custom logic for attention calculation
+        if self.memory_budget is not None:
+            return chunked_patch_attention(query, key, value, self.scale, self.dropout, key_padding_mask, self.memory_budget)
+
         scores = torch.einsum("bnpxyd,bnqxyd->bnpq", query, key) / self.scale
 
         if key_padding_mask is not None:
@@ -417,7 +920,8 @@ class ScaledDotProductAttention_ViTNO(nn.Module):
 
 class TransformerEncoderLayer_ViTNO(nn.Module):#
 
-    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True):
+    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True,
+                 attention_memory_budget=None):
         super(TransformerEncoderLayer_ViTNO, self).__init__()
 
         # Self-attention layer
@@ -428,7 +932,7 @@ class TransformerEncoderLayer_ViTNO(nn.Module):#
             modes1 = modes[0]
             modes2 = modes[1]
         #or im_size?
-        self.self_attn = MultiheadAttention_ViTNO(d_model, nhead, im_size, dropout=dropout)
+        self.self_attn = MultiheadAttention_ViTNO(d_model, nhead, im_size, dropout=dropout, memory_budget=attention_memory_budget)
 
         # Feedforward layer
         self.linear1 = nn.Linear(d_model, dim_feedforward)
@@ -495,36 +999,41 @@ class SpectralConv2d_Attention(nn.Module):
         self.modes2 = modes2
         self.nhead = nhead
         self.scale = (1 / (in_channels * out_channels))
-        #use torch.view_as_real if using ddp
-        #self.weights1 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat)))
-        #self.weights2 = nn.Parameter(self.scale * torch.view_as_real(torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat)))
-        self.weights1 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat)))
-        self.weights2 = nn.Parameter(self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat)))
+        #weights of both frequency bands stacked as real numbers (which also works with ddp), see stack_spectral_weights
+        weights1 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat))
+        weights2 = self.scale * (torch.rand(in_channels, out_channels, self.modes1, self.modes2, self.nhead, dtype=torch.cfloat))
+        self.weights = nn.Parameter(stack_spectral_weights(weights1, weights2))
+        self.out_ft_cache = OrderedDict()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        spectral_weights_state_dict(state_dict, prefix)
+        super(SpectralConv2d_Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     # Complex multiplication
-    def compl_mul2d(self, input, weights):
-        # (batch, num_patches, in_channel, x,y ), (in_channel, out_channel, x,y, nhead) -> (batch, num_patches, out_channel, x,y, nhead)
-        return torch.einsum("bnixy,ioxyh->bnoxyh", input, weights)
+    def compl_mul2d(self, input_low, input_high):
+        # 2 x (batch, num_patches, in_channel, modes1, modes2) -> (batch, num_patches, out_channel, 2*modes1, modes2, nhead), both bands at once
+        out = spectral_mul(input_low.flatten(0, 1), input_high.flatten(0, 1), self.weights)
+        return out.unflatten(1, (self.out_channels, self.nhead)).unflatten(0, input_low.shape[:2]).movedim(3, -1)
 
-    def forward(self, x):
+    def spectrum(self, x):
+        #x is of shape (batch, num_patches, x, y, d_model), returns the spectrum over the patch dimensions
+        return torch.fft.rfft2(torch.permute(x, (0,1,4,2,3)))
+
+    def forward(self, x, x_ft=None):
+        #x_ft can be passed in when the spectrum of x is shared with other operators
         batchsize = x.shape[0]
         num_patches = x.shape[1]
         #Compute Fourier coeffcients up to factor of e^(- something constant)
         #####
         x = torch.permute(x, (0,1,4,2,3))
         #x is of shape (batch, num_patches, d_model, x, y)
-        x_ft = torch.fft.rfft2(x)
+        if x_ft is None:
+            x_ft = torch.fft.rfft2(x)
         # Multiply relevant Fourier modes
-        out_ft = torch.zeros(batchsize, num_patches, self.out_channels,  x.size(-2), x.size(-1)//2 + 1, self.nhead, dtype=torch.cfloat, device=x.device)
-        #use torch.view_as_complex if using ddp
-        #out_ft[:, :, :, :self.modes1, :self.modes2, :] = \
-        #    self.compl_mul2d(x_ft[:, :, :, :self.modes1, :self.modes2], torch.view_as_complex(self.weights1))
-        #out_ft[:, :, :, -self.modes1:, :self.modes2, :] = \
-        #    self.compl_mul2d(x_ft[:, :, :, -self.modes1:, :self.modes2], torch.view_as_complex(self.weights2))
-        out_ft[:, :, :, :self.modes1, :self.modes2, :] = \
-            self.compl_mul2d(x_ft[:, :, :, :self.modes1, :self.modes2], self.weights1)
-        out_ft[:, :, :, -self.modes1:, :self.modes2, :] = \
-            self.compl_mul2d(x_ft[:, :, :, -self.modes1:, :self.modes2], self.weights2)
+        out_ft = spectrum_buffer(self.out_ft_cache, (batchsize, num_patches, self.out_channels,  x.size(-2), x.size(-1)//2 + 1, self.nhead), x.device)
+        out_modes = self.compl_mul2d(x_ft[:, :, :, :self.modes1, :self.modes2], x_ft[:, :, :, -self.modes1:, :self.modes2])
+        out_ft[:, :, :, :self.modes1, :self.modes2, :] = out_modes[:, :, :, :self.modes1]
+        out_ft[:, :, :, -self.modes1:, :self.modes2, :] = out_modes[:, :, :, self.modes1:]
         #Return to physical space
         x = torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)), dim=(-3, -2))
         #####
@@ -534,7 +1043,7 @@ class SpectralConv2d_Attention(nn.Module):
 
 class MultiheadAttention_Conv(nn.Module):
 
-    def __init__(self, d_model, nhead, modes1, modes2, im_size, dropout=0.1):
+    def __init__(self, d_model, nhead, modes1, modes2, im_size, dropout=0.1, memory_budget=None):
         super(MultiheadAttention_Conv, self).__init__()
         self.nhead = nhead
         self.d_k = d_model // nhead
@@ -544,17 +1053,19 @@ class MultiheadAttention_Conv(nn.Module):
         self.key_operator = SpectralConv2d_Attention(d_model, self.d_k, modes1, modes2, nhead)
         self.value_operator = SpectralConv2d_Attention(d_model, self.d_k, modes1, modes2, nhead)
 
-        self.scaled_dot_product_attention = ScaledDotProductAttention_Conv(d_model, im_size, dropout=dropout)
+        self.scaled_dot_product_attention = ScaledDotProductAttention_Conv(d_model, im_size, dropout=dropout, memory_budget=memory_budget)
 
         self.out_linear = nn.Linear(nhead*self.d_k, d_model)
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x, key_padding_mask=None):
         batch, num_patches, patch_size, patch_size, d_model = x.size()
+        #the query, key and value operators share one forward fft of x
+        x_ft = self.query_operator.spectrum(x)
         ###should write a split heads function to do the permutation
-        query = self.query_operator(x).permute(0,5,1,2,3,4)
-        key = self.key_operator(x).permute(0,5,1,2,3,4)
-        value = self.value_operator(x).permute(0,5,1,2,3,4)
+        query = self.query_operator(x, x_ft).permute(0,5,1,2,3,4)
+        key = self.key_operator(x, x_ft).permute(0,5,1,2,3,4)
+        value = self.value_operator(x, x_ft).permute(0,5,1,2,3,4)
         # query, key, and value are of shape (batch, nhead, num_patches,x,y , d_model)
         # Scaled Dot Product Attention
 
@@ -570,14 +1081,19 @@ class MultiheadAttention_Conv(nn.Module):
 
 class ScaledDotProductAttention_Conv(nn.Module):
 
-    def __init__(self, d_model, im_size, dropout=0.1):
+    def __init__(self, d_model, im_size, dropout=0.1, memory_budget=None):
         super(ScaledDotProductAttention_Conv, self).__init__()
         #d_model* or just d_model?
         self.scale = nn.Parameter(torch.sqrt(torch.FloatTensor([((im_size)**4)])), requires_grad=False)
         self.dropout = nn.Dropout(dropout)
+        #bytes of block temporaries allowed in attention, None computes all patches at once
+        self.memory_budget = memory_budget
 
     def forward(self, query, key, value, key_padding_mask=None):
         # Custom logic for attention calculation
+        if self.memory_budget is not None:
+            return chunked_patch_attention(query, key, value, self.scale, self.dropout, key_padding_mask, self.memory_budget), None
+
         scores = torch.einsum("bnpxyd,bnqxyd->bnpq", query, key) / self.scale
         if key_padding_mask is not None:
             scores = scores.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
@@ -589,7 +1105,8 @@ class ScaledDotProductAttention_Conv(nn.Module):
 
 class TransformerEncoderLayer_Conv(nn.Module):#
 
-    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True):
+    def __init__(self, d_model, nhead, dropout=0.1, activation="relu", norm_first=True, do_layer_norm=True, dim_feedforward=2048, modes=None, patch_size=1, im_size=64, batch_first=True,
+                 attention_memory_budget=None):
         super(TransformerEncoderLayer_Conv, self).__init__()
         # Self-attention layer
         if modes is None:
@@ -606,7 +1123,7 @@ class TransformerEncoderLayer_Conv(nn.Module):#
         self.d_model = d_model
 
         #or im_size?
-        self.self_attn = MultiheadAttention_Conv(d_model, nhead, modes1, modes2, im_size, dropout=dropout)
+        self.self_attn = MultiheadAttention_Conv(d_model, nhead, modes1, modes2, im_size, dropout=dropout, memory_budget=attention_memory_budget)
         # Feedforward layer
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -57,6 +57,11 @@ model.model.set_im_size(208,16)
 # Load the data module
 datamodule = MetaDataModule(**config)
 datamodule.setup(stage='test')  # Call the setup method to set up the test data
+if not model.x_normalizer.fitted:
+    # checkpoints saved before the normalizer statistics were part of the model, refitted to the training data
+    x_normalizer, y_normalizer = datamodule.normalizers()
+    model.x_normalizer.set_stats(x_normalizer)
+    model.y_normalizer.set_stats(y_normalizer)
 test_data_loader = datamodule.test_dataloader()  # Retrieve the test data loader
 #change the [1] depending on the sample rates
 test_sample_rate = 2
@@ -72,8 +77,9 @@ predictions = []
 
 for sample in test_data_loader.dataset:
     x, y, coords_x, coords_y = sample
-    x = torch.from_numpy(x).to(device)
-    y = torch.from_numpy(y).to(device)
+    # the datasets store unnormalized data, normalized with the statistics of the training data
+    x = model.x_normalizer.encode(torch.from_numpy(x).to(device))
+    y = model.y_normalizer.encode(torch.from_numpy(y).to(device))
     coords_x = torch.from_numpy(coords_x).to(device)
     coords_y = torch.from_numpy(coords_y).to(device)
     with torch.no_grad():
@@ -110,6 +116,8 @@ min_error = errors[min_error_idx]
 # Retrieve the corresponding data for these samples
 x_median, y_median, coords_x_median, coords_y_median = test_data_loader.dataset[median_idx]
 x_min, y_min, coords_x_min, coords_y_min = test_data_loader.dataset[min_error_idx]
+x_median, x_min = [model.x_normalizer.encode(torch.from_numpy(x).to(device)).cpu().numpy() for x in (x_median, x_min)]
+y_median, y_min = [model.y_normalizer.encode(torch.from_numpy(y).to(device)).cpu().numpy() for y in (y_median, y_min)]
 
 y_pred_min = predictions[min_error_idx]
 y_pred_median = predictions[median_idx]
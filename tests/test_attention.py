@@ -0,0 +1,161 @@
+import pytest
+import torch
+
+from models.transformer_custom import (GridContext, KernelizedAttention, Quadrature, ScaledDotProductAttention,
+                                       ScaledDotProductAttention_Conv, ScaledDotProductAttention_Operator,
+                                       ScaledDotProductAttention_ViTNO, trapezoid_weights)
+
+
+def make_inputs(batch=2, nhead=3, seq_len=37, d_k=8, domain_dim=1, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    query, key, value = [torch.randn(batch, nhead, seq_len, d_k, generator=generator) for _ in range(3)]
+    # a non-uniform grid, so that every key has its own quadrature weight
+    coords = torch.rand(seq_len, domain_dim, 1, generator=generator)
+    if domain_dim == 1:
+        coords = torch.sort(coords, dim=0)[0]
+    return query, key, value, coords
+
+
+def reference_attention(query, key, value, coords):
+    '''the original continuum attention, with the two trapezoid sums over neighbouring keys'''
+    scores = torch.einsum("bhld,bhsd->bhls", query, key) / query.shape[-1]**0.5
+    dx = torch.abs(coords[1:] - coords[:-1]).permute(1, 2, 0).unsqueeze(0)
+    exp_scores = torch.exp(scores - scores.max(dim=-1, keepdim=True)[0])
+    attention_weights = exp_scores / (0.5*dx*(exp_scores[..., 1:] + exp_scores[..., :-1])).sum(dim=-1, keepdim=True)
+    dx = dx.permute(0, 1, 3, 2)
+    output1 = torch.einsum("bhls,bhsd->bhld", attention_weights[..., 1:], dx*value[..., 1:, :])
+    output2 = torch.einsum("bhls,bhsd->bhld", attention_weights[..., :-1], dx*value[..., :-1, :])
+    return 0.5*(output1 + output2)
+
+
+def attention(query, key, value, coords, key_padding_mask=None, **kwargs):
+    module = ScaledDotProductAttention(query.shape[-1], dropout=0., **kwargs)
+    return module(query, key, value, coords, key_padding_mask)
+
+
+def test_weighted_matmul_matches_trapezoid_sums():
+    query, key, value, coords = make_inputs()
+    output = attention(query, key, value, coords, use_sdpa=False)
+    torch.testing.assert_close(output, reference_attention(query, key, value, coords), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('kwargs', [{'use_sdpa': False}, {}, {'chunk_size': 4}, {'quadrature': 'simpson'}])
+def test_single_point_grid_matches_trapezoid_sums(kwargs):
+    # every quadrature weight of a single point grid is zero, so is the integral
+    query, key, value, coords = make_inputs(seq_len=1)
+    output = attention(query, key, value, coords, **kwargs)
+    torch.testing.assert_close(output, reference_attention(query, key, value, coords))
+
+
+@pytest.mark.parametrize('domain_dim', [1, 2])
+@pytest.mark.parametrize('quadrature', ['trapezoid', 'riemann'])
+@pytest.mark.parametrize('masked', [False, True])
+def test_sdpa_matches_einsum(domain_dim, quadrature, masked):
+    query, key, value, coords = make_inputs(domain_dim=domain_dim)
+    key_padding_mask = None
+    if masked:
+        key_padding_mask = torch.zeros(query.shape[0], query.shape[2], dtype=torch.bool)
+        key_padding_mask[1, :4] = True
+    expected = attention(query, key, value, coords, key_padding_mask, quadrature=quadrature, use_sdpa=False)
+    output = attention(query, key, value, coords, key_padding_mask, quadrature=quadrature)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+    # the bias of a shared GridContext is computed once and reused by every layer
+    grid = GridContext(coords, quadrature=Quadrature(quadrature), key_padding_mask=key_padding_mask)
+    torch.testing.assert_close(attention(query, key, value, grid, quadrature=quadrature), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_sdpa_gradients_match_einsum():
+    inputs = [t.requires_grad_() for t in make_inputs()[:3]]
+    coords = make_inputs()[3]
+    expected = torch.autograd.grad(attention(*inputs, coords, use_sdpa=False).square().sum(), inputs)
+    grads = torch.autograd.grad(attention(*inputs, coords).square().sum(), inputs)
+    for grad, expected_grad in zip(grads, expected):
+        torch.testing.assert_close(grad, expected_grad, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('domain_dim', [1, 2])
+@pytest.mark.parametrize('chunk_size', [1, 8, 64])
+@pytest.mark.parametrize('masked', [False, True])
+def test_chunked_matches_einsum(domain_dim, chunk_size, masked):
+    query, key, value, coords = make_inputs(domain_dim=domain_dim)
+    key_padding_mask = None
+    if masked:
+        key_padding_mask = torch.zeros(query.shape[0], query.shape[2], dtype=torch.bool)
+        key_padding_mask[0, -5:] = True
+    expected = attention(query, key, value, coords, key_padding_mask, use_sdpa=False)
+    output = attention(query, key, value, coords, key_padding_mask, chunk_size=chunk_size)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_chunked_gradients_match_einsum():
+    inputs = [t.requires_grad_() for t in make_inputs()[:3]]
+    coords = make_inputs()[3]
+    expected = torch.autograd.grad(attention(*inputs, coords, use_sdpa=False).square().sum(), inputs)
+    grads = torch.autograd.grad(attention(*inputs, coords, chunk_size=8).square().sum(), inputs)
+    for grad, expected_grad in zip(grads, expected):
+        torch.testing.assert_close(grad, expected_grad, rtol=1e-4, atol=1e-5)
+
+
+def reference_kernel_attention(query_features, key_features, value, weights):
+    '''sum_s w_s phi(q).phi(k_s) v_s / sum_s w_s phi(q).phi(k_s), with the kernel matrix formed explicitly'''
+    kernel = torch.einsum("bhlm,bhsm->bhls", query_features, key_features) * weights
+    return torch.einsum("bhls,bhsd->bhld", kernel, value) / kernel.sum(dim=-1, keepdim=True)
+
+
+@pytest.mark.parametrize('feature_map', ['elu', 'random'])
+@pytest.mark.parametrize('domain_dim', [1, 2])
+def test_kernelized_output(feature_map, domain_dim):
+    torch.manual_seed(0)
+    query, key, value, coords = make_inputs(domain_dim=domain_dim)
+    output = KernelizedAttention(query.shape[-1], feature_map=feature_map)(query, key, value, coords)
+    assert output.shape == value.shape
+    assert torch.isfinite(output).all()
+
+
+@pytest.mark.parametrize('feature_map', ['elu', 'random'])
+def test_kernelized_respects_quadrature_and_padding(feature_map):
+    torch.manual_seed(0)
+    query, key, value, coords = make_inputs()
+    key_padding_mask = torch.zeros(query.shape[0], query.shape[2], dtype=torch.bool)
+    key_padding_mask[0, -5:] = True
+    module = KernelizedAttention(query.shape[-1], feature_map=feature_map)
+    output = module(query, key, value, coords, key_padding_mask)
+
+    weights = trapezoid_weights(coords) * ~key_padding_mask.unsqueeze(1).unsqueeze(2)
+    expected = reference_kernel_attention(module.features(query, is_query=True), module.features(key, is_query=False),
+                                          value, weights)
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-5)
+    # padded keys and values have no influence
+    key, value = key.clone(), value.clone()
+    key[0, :, -5:], value[0, :, -5:] = 100., 100.
+    torch.testing.assert_close(module(query, key, value, coords, key_padding_mask), output, rtol=1e-4, atol=1e-5)
+
+
+def test_random_features_approximate_softmax():
+    torch.manual_seed(0)
+    query, key, value, coords = make_inputs(batch=1, nhead=2, seq_len=12, d_k=4)
+    query, key = 0.5*query, 0.5*key
+    expected = attention(query, key, value, coords, use_sdpa=False)
+    output = KernelizedAttention(4, feature_map='random', num_features=16384)(query, key, value, coords)
+    torch.testing.assert_close(output, expected, rtol=0, atol=2e-2)
+
+
+@pytest.mark.parametrize('module_class', [ScaledDotProductAttention_ViTNO, ScaledDotProductAttention_Operator,
+                                          ScaledDotProductAttention_Conv])
+# budgets of one patch per block, three patches per block and all patches at once
+@pytest.mark.parametrize('memory_budget', [1, 3*5*2*3*4*4*5*4, 10**9])
+@pytest.mark.parametrize('masked', [False, True])
+def test_chunked_patch_attention_matches_einsum(module_class, memory_budget, masked):
+    generator = torch.Generator().manual_seed(0)
+    # (batch, nhead, num_patches, x, y, d)
+    query, key, value = [torch.randn(2, 3, 7, 4, 4, 5, generator=generator) for _ in range(3)]
+    key_padding_mask = None
+    if masked:
+        key_padding_mask = torch.zeros(2, 7, dtype=torch.bool)
+        key_padding_mask[1, 2:5] = True
+    expected = module_class(5, 2, dropout=0.)(query, key, value, key_padding_mask)
+    output = module_class(5, 2, dropout=0., memory_budget=memory_budget)(query, key, value, key_padding_mask)
+    if isinstance(expected, tuple):
+        # the FANO modules also return the attention weights, which are never formed in blocks
+        expected, output = expected[0], output[0]
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
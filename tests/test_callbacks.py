@@ -0,0 +1,82 @@
+import pytest
+import pytorch_lightning as pl
+import torch
+import torch.nn as nn
+from pytorch_lightning.loggers import Logger
+from torch.utils.data import DataLoader, TensorDataset
+
+from callbacks import NormMonitor
+
+
+class RecordingLogger(Logger):
+    def __init__(self):
+        super().__init__()
+        self.metrics = []
+
+    @property
+    def name(self):
+        return 'recording'
+
+    @property
+    def version(self):
+        return 0
+
+    def log_hyperparams(self, params, *args, **kwargs):
+        pass
+
+    def log_metrics(self, metrics, step=None):
+        self.metrics.append((step, metrics))
+
+
+class ToyModule(pl.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(3, 2)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        return nn.functional.mse_loss(self.linear(x), y)
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+class NormProbe(pl.Callback):
+    '''the norms of every optimizer step, computed one parameter at a time'''
+    def __init__(self):
+        self.norms = {}
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer):
+        params = list(pl_module.parameters())
+        self.norms[trainer.global_step] = {
+            'grad_norm/beforeOptimizer/total': torch.linalg.vector_norm(torch.stack([p.grad.norm() for p in params])).item(),
+            'param_norm/beforeOptimizer/total': torch.linalg.vector_norm(torch.stack([p.norm() for p in params])).item()}
+
+
+@pytest.mark.parametrize('accumulate_grad_batches', [1, 3])
+def test_norms_are_logged_at_the_configured_interval(accumulate_grad_batches):
+    torch.manual_seed(0)
+    data = TensorDataset(torch.randn(48, 3), torch.randn(48, 2))
+    logger, probe = RecordingLogger(), NormProbe()
+    trainer = pl.Trainer(max_epochs=2, logger=logger, callbacks=[NormMonitor(log_every_n_steps=2), probe],
+                         accumulate_grad_batches=accumulate_grad_batches, enable_checkpointing=False,
+                         enable_progress_bar=False, enable_model_summary=False, accelerator='cpu', log_every_n_steps=1)
+    trainer.fit(ToyModule(), DataLoader(data, batch_size=4))
+
+    logged = {}
+    for step, metrics in logger.metrics:
+        for name, value in metrics.items():
+            if 'norm/' in name:
+                # each norm once per logged optimizer step, whatever the number of accumulated micro-batches
+                assert (step, name) not in logged
+                logged[step, name] = value
+    steps = list(range(0, trainer.global_step, 2))
+    assert sorted(logged) == sorted((step, name) for step in steps for name in probe.norms[0])
+    for (step, name), value in logged.items():
+        assert value == pytest.approx(probe.norms[step][name], rel=1e-5)
+
+
+@pytest.mark.parametrize('log_every_n_steps', [0, -1, None])
+def test_non_positive_interval_is_rejected(log_every_n_steps):
+    with pytest.raises(ValueError):
+        NormMonitor(log_every_n_steps=log_every_n_steps)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from datasets import (DynamicsDataModule, Spatial2dDataset, TensorBatches, batch_shared, make_dataloader,
+                      make_tensor_dataloader)
+
+
+def make_datamodule(tmp_path, **kwargs):
+    datamodule = DynamicsDataModule(batch_size=8, size={'train': 30, 'val': 10, 'test': 10}, T={'train': 0.5, 'val': 0.5, 'test': 0.5},
+                                    train_sample_rate=0.05, test_sample_rates=[0.05], params={}, cache_dir=str(tmp_path), **kwargs)
+    datamodule.setup('fit')
+    return datamodule
+
+
+def test_one_loader_per_split(tmp_path):
+    datamodule = make_datamodule(tmp_path, num_workers=1, persistent_workers=True)
+    loader = datamodule.train_dataloader()
+    list(loader)
+    workers = loader._iterator._workers
+    assert datamodule.train_dataloader() is loader
+    assert all(worker.is_alive() for worker in workers)
+
+    # the batch size tuner changes the batch size, the loader is replaced and its workers shut down
+    datamodule.batch_size = 4
+    replaced = datamodule.train_dataloader()
+    assert replaced is not loader and len(replaced) == 8
+    assert not any(worker.is_alive() for worker in workers)
+    assert list(datamodule.dataloaders) == ['train']
+
+    list(replaced)
+    workers = replaced._iterator._workers
+    datamodule.setup('fit')
+    assert datamodule.dataloaders == {}
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def spatial_dataset(size=21):
+    x = torch.randn(size, 25, 1).numpy()
+    y = torch.randn(size, 25, 1).numpy()
+    coords = torch.rand(25, 2).numpy()
+    return Spatial2dDataset(x, y, coords, coords)
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, 8, 30])
+def test_tensor_batches_match_collated_samples(tmp_path, batch_size):
+    for dataset in (make_datamodule(tmp_path).train, spatial_dataset()):
+        expected = list(make_dataloader(dataset, batch_size))
+        batches = list(make_tensor_dataloader(TensorBatches(dataset), batch_size))
+        assert len(batches) == len(expected)
+        for batch, expected_batch in zip(batches, expected):
+            for tensor, expected_tensor in zip(batch, expected_batch):
+                torch.testing.assert_close(tensor, expected_tensor, rtol=0, atol=0)
+            # the coordinates are views shared by the batch, as from shared_coords_collate
+            if batch[0].shape[0] > 1:
+                assert batch_shared(batch[2]) and batch_shared(batch[3])
+
+
+def test_shuffled_tensor_batches_cover_every_sample_once():
+    dataset = spatial_dataset()
+    loader = make_tensor_dataloader(TensorBatches(dataset), 4, shuffle=True)
+    epochs = []
+    for _ in range(2):
+        x = torch.cat([batch[0] for batch in loader])
+        order = [int(np.flatnonzero((dataset.x == sample.numpy()).all(axis=(1, 2)))[0]) for sample in x]
+        assert sorted(order) == list(range(len(dataset)))
+        epochs.append(order)
+    assert epochs[0] != epochs[1]
+
+
+def test_tensor_batches_do_not_write_through_to_the_dataset():
+    dataset = spatial_dataset()
+    coords = dataset.active_coordinates_x.copy()
+    batch = TensorBatches(dataset)[slice(0, 4)]
+    batch[2][0].fill_(0.)
+    np.testing.assert_array_equal(dataset.active_coordinates_x, coords)
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+
+from datasets import NpySamples
+from utils import UnitGaussianNormalizer
+
+
+def make_data(seed=0, offset=0.):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((1000, 3)) * np.array([1., 10., 0.1]) + offset
+
+
+def test_update_matches_numpy():
+    x = make_data()
+    normalizer = UnitGaussianNormalizer()
+    for chunk in np.array_split(x, [1, 7, 300, 301, 650]):
+        normalizer.update(chunk)
+    np.testing.assert_allclose(normalizer.mean, x.mean(0), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(normalizer.std, x.std(0), rtol=1e-12)
+    assert normalizer.count == x.shape[0]
+
+
+def test_merge_is_order_independent():
+    x = make_data()
+    parts = []
+    for chunk in np.array_split(x, 4):
+        part = UnitGaussianNormalizer()
+        part.update(chunk)
+        parts.append(part)
+    forward, backward = UnitGaussianNormalizer(), UnitGaussianNormalizer()
+    for part in parts:
+        forward.merge(part)
+    # an empty normalizer, e.g. from a process without blocks, changes nothing
+    backward.merge(UnitGaussianNormalizer())
+    for part in reversed(parts):
+        backward.merge(part)
+    for normalizer in (forward, backward):
+        np.testing.assert_allclose(normalizer.mean, x.mean(0), rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(normalizer.std, x.std(0), rtol=1e-12)
+
+
+def test_merge_is_stable_with_a_large_mean():
+    # sums of squares would cancel catastrophically, the pairwise update of the deviations does not
+    x = make_data(offset=1e8)
+    normalizer = UnitGaussianNormalizer()
+    for chunk in np.array_split(x, 10):
+        normalizer.update(chunk)
+    np.testing.assert_allclose(normalizer.std, x.std(0), rtol=1e-6)
+
+
+def test_save_and_load_keep_the_moments(tmp_path):
+    x = make_data()
+    normalizer = UnitGaussianNormalizer()
+    normalizer.update(x[:500])
+    normalizer.save(os.path.join(tmp_path, 'stats.npz'))
+    loaded = UnitGaussianNormalizer.load(os.path.join(tmp_path, 'stats.npz'))
+    np.testing.assert_array_equal(loaded.mean, normalizer.mean)
+    np.testing.assert_array_equal(loaded.std, normalizer.std)
+    # accumulation continues from the loaded moments
+    loaded.update(x[500:])
+    np.testing.assert_allclose(loaded.std, x.std(0), rtol=1e-12)
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_lazy_samples_match_the_in_memory_fit(tmp_path, num_workers):
+    samples = np.random.default_rng(0).standard_normal((50, 8, 6)).astype(np.float32) * 3 + 1
+    fname = os.path.join(tmp_path, 'x.npy')
+    np.save(fname, samples)
+    view = NpySamples(fname, indices=np.arange(3, 47, 2), points=np.array([[0, 0], [2, 5], [7, 3]]))
+    expected = UnitGaussianNormalizer(samples[3:47:2][:, [0, 2, 7], [0, 5, 3]].reshape(-1, 1))
+
+    normalizer = view.fit_normalizer(block_size=4, num_workers=num_workers, cache_dir=str(tmp_path))
+    assert normalizer.mean.dtype == expected.mean.dtype
+    np.testing.assert_allclose(normalizer.mean, expected.mean, rtol=1e-6)
+    np.testing.assert_allclose(normalizer.std, expected.std, rtol=1e-6)
+    # later fits of the same view read the persisted statistics
+    cached = view.fit_normalizer(block_size=4, cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(cached.mean, normalizer.mean)
+    assert os.path.exists(os.path.join(tmp_path, f'stats_{view.stats_key()}.npz'))
@@ -0,0 +1,82 @@
+import math
+
+import pytest
+import torch
+
+import datasets
+from datasets import Lorenz63, multirate_times, rk4_solve, solve_trajectories, split_multirate
+
+
+def solve(sample_rates, params=None, T=0.3, size=4, seed=0):
+    torch.manual_seed(seed)
+    return solve_trajectories(Lorenz63(params=params), 'Lorenz63', size, T, sample_rates)
+
+
+@pytest.mark.parametrize('sample_rates', [[0.05, 0.02], [0.05, 0.02, 0.0075]])
+def test_split_multirate_matches_a_solve_per_rate(sample_rates):
+    split = split_multirate(*solve(sample_rates), 0.3, sample_rates)
+    for dt in sample_rates:
+        xyz, times, control = solve(dt)
+        torch.testing.assert_close(split[dt][1], times, rtol=0, atol=0)
+        # the adaptive steps do not depend on the output times, so the subsampled solve is the direct one
+        torch.testing.assert_close(split[dt][0], xyz, rtol=0, atol=0)
+        assert split[dt][2] is None and control is None
+
+
+def test_split_multirate_with_fixed_steps():
+    # the fixed-step solver splits the intervals of the union grid differently, so only up to its error
+    params = {'method': 'rk4', 'step_size': 1e-3}
+    sample_rates = [0.05, 0.0075]
+    split = split_multirate(*solve(sample_rates, params=params), 0.3, sample_rates)
+    for dt in sample_rates:
+        torch.testing.assert_close(split[dt][0], solve(dt, params=params)[0], rtol=1e-4, atol=1e-4)
+
+
+def test_multirate_times_contain_every_grid():
+    times = multirate_times(1., [0.1, 0.03])
+    assert torch.all(times[1:] > times[:-1])
+    for dt in (0.1, 0.03):
+        assert torch.isin(torch.arange(0, 1., dt), times).all()
+
+
+def decay_into(t, x, out):
+    return torch.mul(x, -2., out=out)
+
+
+def oscillator_into(t, x, out):
+    # x'' = -x as the first order system (x, v)
+    out[:, 0], out[:, 1] = x[:, 1], -x[:, 0]
+    return out
+
+
+def test_rk4_solves_exponential_decay():
+    x0 = torch.tensor([[1.], [3.]], dtype=torch.float64)
+    times = torch.linspace(0, 2, 11, dtype=torch.float64)
+    xyz = rk4_solve(decay_into, x0, times, step_size=0.01)
+    expected = x0 * torch.exp(-2*times)[:, None, None]
+    torch.testing.assert_close(xyz, expected, rtol=1e-8, atol=0)
+
+
+def test_rk4_is_fourth_order_on_the_oscillator():
+    x0 = torch.tensor([[1., 0.]], dtype=torch.float64)
+    times = torch.tensor([0., 2*math.pi], dtype=torch.float64)
+    errors = [(rk4_solve(oscillator_into, x0, times, step_size=h)[-1] - x0).abs().max() for h in (0.1, 0.05)]
+    # halving the step divides the error by 2^4
+    assert 14 < errors[0] / errors[1] < 18
+
+
+def test_set_solver_routes_solve_through_rk4(monkeypatch):
+    def odeint(*args, **kwargs):
+        raise AssertionError('the rk4 method must not call odeint')
+    monkeypatch.setattr(datasets, 'odeint', odeint)
+    dynsys = Lorenz63(params={'method': 'rk4', 'step_size': 1e-3})
+    assert (dynsys.method, dynsys.step_size) == ('rk4', 1e-3)
+    torch.manual_seed(0)
+    xyz, times = dynsys.solve(N_traj=3, T=0.3, dt=0.05)
+    torch.manual_seed(0)
+    expected = rk4_solve(dynsys.rhs_into, dynsys.get_inits(3), torch.arange(0, 0.3, 0.05), 1e-3)
+    torch.testing.assert_close(xyz, expected, rtol=0, atol=0)
+    monkeypatch.undo()
+    # and stays close to the default adaptive solver
+    torch.manual_seed(0)
+    torch.testing.assert_close(xyz, Lorenz63().solve(N_traj=3, T=0.3, dt=0.05)[0], rtol=1e-3, atol=1e-3)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from scipy.integrate import simpson
+
+from models.transformer_custom import Quadrature, riemann_weights, simpson_weights, trapezoid_weights
+
+
+def make_grid(num_points, seed=0):
+    '''a sorted, non-uniform 1D grid of shape (num_points, 1, 1) on [0, 1]'''
+    generator = torch.Generator().manual_seed(seed)
+    inner = torch.sort(torch.rand(num_points - 2, generator=generator, dtype=torch.float64))[0]
+    return torch.cat((torch.zeros(1, dtype=torch.float64), inner, torch.ones(1, dtype=torch.float64))).reshape(-1, 1, 1)
+
+
+def test_trapezoid_matches_torch():
+    coords = make_grid(17)
+    f = torch.cos(3*coords[:, 0, 0])
+    torch.testing.assert_close(trapezoid_weights(coords) @ f, torch.trapezoid(f, coords[:, 0, 0]))
+
+
+def test_riemann_is_left_sum():
+    coords = make_grid(17)
+    x, f = coords[:, 0, 0], torch.cos(3*coords[:, 0, 0])
+    expected = sum(f[i] * (x[i+1] - x[i]) for i in range(len(x) - 1))
+    torch.testing.assert_close(riemann_weights(coords) @ f, expected)
+    assert riemann_weights(coords)[-1] == 0
+
+
+def test_simpson_matches_scipy():
+    # an even number of intervals, where scipy applies composite Simpson on every pair of them
+    coords = make_grid(17)
+    x, f = coords[:, 0, 0], torch.cos(3*coords[:, 0, 0])
+    torch.testing.assert_close(simpson_weights(coords) @ f, torch.tensor(simpson(f.numpy(), x=x.numpy())))
+
+
+@pytest.mark.parametrize('num_points', [3, 16, 17])
+def test_simpson_is_exact_for_quadratics(num_points):
+    coords = make_grid(num_points)
+    x = coords[:, 0, 0]
+    weights = simpson_weights(coords)
+    if (num_points - 1) % 2:
+        # the last interval falls back to the trapezoid rule, which is exact for linear functions only
+        torch.testing.assert_close(weights @ (2*x - 1), torch.tensor(0., dtype=torch.float64))
+        pairs = simpson_weights(coords[:-1])
+        trapezoid = trapezoid_weights(coords[-2:])
+        torch.testing.assert_close(weights, torch.cat((pairs[:-1], pairs[-1:] + trapezoid[:1], trapezoid[1:])))
+    else:
+        torch.testing.assert_close(weights @ (3*x**2 - 2*x + 1), torch.tensor(1., dtype=torch.float64))
+
+
+def test_precomputed_weights():
+    weights = np.linspace(0.5, 1.5, 9)
+    quadrature = Quadrature(weights)
+    assert quadrature.nonnegative
+    torch.testing.assert_close(quadrature(make_grid(9).float()), torch.as_tensor(weights, dtype=torch.float))
+    with pytest.raises(ValueError):
+        quadrature(make_grid(8).float())
+    with pytest.raises(ValueError):
+        Quadrature('midpoint')
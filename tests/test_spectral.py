@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from models.transformer_custom import MultiheadAttention_Operator, SpectralConv2d
+
+
+def band_weights(module):
+    '''the complex (in_channels, out_channels, modes1, modes2) weights of both bands, unstacked from module.weights'''
+    weights = torch.view_as_complex(module.weights.detach())
+    weights = weights.view(2, module.modes1, module.modes2, module.in_channels, module.out_channels)
+    return weights.permute(0, 3, 4, 1, 2).unbind(0)
+
+
+def reference_spectral_conv(x, weights1, weights2):
+    '''the original forward, with the whole zero padded spectrum transformed back by irfft2'''
+    modes1, modes2 = weights1.shape[-2:]
+    x_ft = torch.fft.rfft2(x)
+    out_ft = torch.zeros(x.shape[0], weights1.shape[1], x.size(-2), x.size(-1)//2 + 1, dtype=torch.cfloat)
+    out_ft[:, :, :modes1, :modes2] = torch.einsum("bixy,ioxy->boxy", x_ft[:, :, :modes1, :modes2], weights1)
+    out_ft[:, :, -modes1:, :modes2] = torch.einsum("bixy,ioxy->boxy", x_ft[:, :, -modes1:, :modes2], weights2)
+    return torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)))
+
+
+@pytest.mark.parametrize('inverse_transform', ['fft', 'dft', 'auto'])
+@pytest.mark.parametrize('batch, in_channels', [(2, 1), (2, 6), (16, 3)])
+@pytest.mark.parametrize('rows, cols, modes1, modes2', [(16, 16, 4, 5), (12, 15, 3, 8), (16, 16, 8, 9), (10, 8, 5, 5)])
+def test_spectral_conv_matches_full_inverse(inverse_transform, batch, in_channels, rows, cols, modes1, modes2):
+    torch.manual_seed(0)
+    module = SpectralConv2d(in_channels, 4, modes1, modes2, inverse_transform=inverse_transform)
+    x = torch.randn(batch, in_channels, rows, cols)
+    expected = reference_spectral_conv(x, *band_weights(module))
+    torch.testing.assert_close(module(x), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('inverse_transform', ['fft', 'dft'])
+def test_spectral_conv_gradients_match_full_inverse(inverse_transform):
+    torch.manual_seed(0)
+    module = SpectralConv2d(3, 4, 4, 5, inverse_transform=inverse_transform)
+    x = torch.randn(2, 3, 16, 12, requires_grad=True)
+    weights1, weights2 = [w.clone().requires_grad_() for w in band_weights(module)]
+    expected = torch.autograd.grad(reference_spectral_conv(x, weights1, weights2).square().sum(), (x, weights1, weights2))
+    grad_x, grad_weights = torch.autograd.grad(module(x).square().sum(), (x, module.weights))
+    torch.testing.assert_close(grad_x, expected[0], rtol=1e-4, atol=1e-5)
+    grads = torch.view_as_complex(grad_weights).view(2, 4, 5, 3, 4).permute(0, 3, 4, 1, 2)
+    torch.testing.assert_close(grads[0], expected[1], rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(grads[1], expected[2], rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('inverse_transform', ['fft', 'dft'])
+def test_spectral_conv_after_inference_mode(inverse_transform):
+    # cached dft matrices and spectrum buffers made under inference mode must not reach autograd
+    module = SpectralConv2d(3, 4, 4, 5, inverse_transform=inverse_transform)
+    x = torch.randn(2, 3, 16, 12)
+    with torch.inference_mode():
+        module(x)
+    module(x).sum().backward()
+    assert module.weights.grad is not None
+
+
+def test_inverse_transform_is_keyword_only():
+    with pytest.raises(TypeError):
+        SpectralConv2d(3, 4, 4, 5, 'dft')
+
+
+def test_operator_attention_runs_with_and_without_memory_budget():
+    x = torch.randn(2, 4, 4, 4, 6)
+    outputs = []
+    for memory_budget in (None, 1):
+        torch.manual_seed(0)
+        module = MultiheadAttention_Operator(6, 2, 2, 2, im_size=8, dropout=0., memory_budget=memory_budget)
+        outputs.append(module(x))
+    assert outputs[0].shape == x.shape and torch.isfinite(outputs[0]).all()
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.transformer_custom import MultiHeadAttention, MultiheadAttention_ViTNO, SpectralConv2d, SpectralConv2d_in
+from utils import TorchUnitGaussianNormalizer, UnitGaussianNormalizer
+
+
+def separate_qkv_state_dict(module, prefix, seed=0):
+    '''the state dict of a module saved before the fused W_qkv projection, with separate W_q, W_k, W_v'''
+    torch.manual_seed(seed)
+    state_dict = {f'{prefix}{name}': value for name, value in module.state_dict().items() if not name.startswith('W_qkv')}
+    for name in ('q', 'k', 'v'):
+        linear = nn.Linear(module.d_model, module.nhead*module.d_k)
+        state_dict[f'{prefix}W_{name}.weight'], state_dict[f'{prefix}W_{name}.bias'] = linear.weight.data, linear.bias.data
+    return state_dict
+
+
+def project(x, state_dict, prefix, name):
+    return F.linear(x, state_dict[f'{prefix}W_{name}.weight'], state_dict[f'{prefix}W_{name}.bias'])
+
+
+def test_separate_qkv_checkpoint_loads_into_multi_head_attention():
+    module = MultiHeadAttention(d_model=12, nhead=3, dropout=0.).eval()
+    container = nn.ModuleDict({'self_attn': module})
+    state_dict = separate_qkv_state_dict(module, 'self_attn.')
+    container.load_state_dict(dict(state_dict))
+
+    x = torch.randn(2, 10, 12)
+    coords = torch.linspace(0, 1, 10).reshape(10, 1, 1)
+    # the original forward, with one projection and head split per query, key and value
+    Q, K, V = [project(x, state_dict, 'self_attn.', name).view(2, -1, 3, 4).transpose(1, 2) for name in ('q', 'k', 'v')]
+    attn_output = module.scaled_dot_product_attention(Q, K, V, coords)
+    expected = module.W_o(attn_output.transpose(1, 2).reshape(2, -1, 12))
+    torch.testing.assert_close(module(x, coords), expected)
+
+
+def test_separate_qkv_checkpoint_loads_into_vitno_attention():
+    module = MultiheadAttention_ViTNO(d_model=12, nhead=3, im_size=8, dropout=0.).eval()
+    state_dict = separate_qkv_state_dict(module, '')
+    module.load_state_dict(dict(state_dict))
+
+    x = torch.randn(2, 4, 5, 5, 12)
+    # the original head split of the ViTNO attention, (d_k, nhead) ordered features
+    Q, K, V = [project(x, state_dict, '', name).view(2, 4, 5, 5, 4, 3).permute(0, 5, 1, 2, 3, 4) for name in ('q', 'k', 'v')]
+    attn_output = module.scaled_dot_product_attention(Q, K, V)
+    expected = module.W_o(attn_output.reshape(2, 4, 5, 5, 12))
+    torch.testing.assert_close(module(x), expected)
+
+
+@pytest.mark.parametrize('as_real', [False, True])
+def test_separate_band_checkpoint_loads_into_spectral_conv(as_real):
+    # checkpoints of either band, complex or through torch.view_as_real as for ddp
+    weights1, weights2 = [0.1*torch.randn(3, 4, 4, 5, dtype=torch.cfloat) for _ in range(2)]
+    state_dict = {'conv.weights1': weights1, 'conv.weights2': weights2}
+    if as_real:
+        state_dict = {name: torch.view_as_real(weights) for name, weights in state_dict.items()}
+    module = SpectralConv2d(3, 4, 4, 5)
+    nn.ModuleDict({'conv': module}).load_state_dict(state_dict)
+
+    x = torch.randn(2, 3, 16, 12)
+    x_ft = torch.fft.rfft2(x)
+    out_ft = torch.zeros(2, 4, 16, 7, dtype=torch.cfloat)
+    out_ft[:, :, :4, :5] = torch.einsum("bixy,ioxy->boxy", x_ft[:, :, :4, :5], weights1)
+    out_ft[:, :, -4:, :5] = torch.einsum("bixy,ioxy->boxy", x_ft[:, :, -4:, :5], weights2)
+    torch.testing.assert_close(module(x), torch.fft.irfft2(out_ft, s=(16, 12)), rtol=1e-4, atol=1e-5)
+
+
+def test_separate_band_checkpoint_loads_into_patch_spectral_conv():
+    weights1, weights2 = [0.1*torch.randn(3, 4, 3, 3, dtype=torch.cfloat) for _ in range(2)]
+    module = SpectralConv2d_in(3, 4, 3, 3)
+    module.load_state_dict({'weights1': weights1, 'weights2': weights2})
+
+    x = torch.randn(2, 5, 3, 8, 8)
+    x_ft = torch.fft.rfft2(x)
+    out_ft = torch.zeros(2, 5, 4, 8, 5, dtype=torch.cfloat)
+    out_ft[:, :, :, :3, :3] = torch.einsum("bpixy,ioxy->bpoxy", x_ft[:, :, :, :3, :3], weights1)
+    out_ft[:, :, :, -3:, :3] = torch.einsum("bpixy,ioxy->bpoxy", x_ft[:, :, :, -3:, :3], weights2)
+    torch.testing.assert_close(module(x), torch.fft.irfft2(out_ft, s=(8, 8)), rtol=1e-4, atol=1e-5)
+
+
+def test_checkpoint_without_normalizer_statistics_loads_unfitted():
+    model = nn.ModuleDict({'linear': nn.Linear(2, 2), 'x_normalizer': TorchUnitGaussianNormalizer(2)})
+    state_dict = {name: value for name, value in model.state_dict().items() if 'normalizer' not in name}
+    model.load_state_dict(state_dict)
+    assert not model['x_normalizer'].fitted
+
+    model['x_normalizer'].set_stats(UnitGaussianNormalizer(mean=np.array([1., 2.]), std=np.array([3., 4.])))
+    assert model['x_normalizer'].fitted
+    restored = nn.ModuleDict({'linear': nn.Linear(2, 2), 'x_normalizer': TorchUnitGaussianNormalizer(2)})
+    restored.load_state_dict(model.state_dict())
+    assert restored['x_normalizer'].fitted
+    torch.testing.assert_close(restored['x_normalizer'].std, torch.tensor([3., 4.]))
+    # a checkpoint with only part of the statistics is still an error
+    partial = {name: value for name, value in model.state_dict().items() if name != 'x_normalizer.std'}
+    with pytest.raises(RuntimeError):
+        restored.load_state_dict(partial)
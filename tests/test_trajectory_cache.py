@@ -0,0 +1,72 @@
+import os
+
+import torch
+
+import datasets
+from datasets import DynamicsDataset, load_trajectories, solve_trajectory_chunk, trajectory_cache_key
+
+
+def load(cache_dir, dyn_sys_name='Lorenz63', size=12, split='train', **kwargs):
+    params = {'size': size}
+    dynsys = datasets.load_dyn_sys_class(dyn_sys_name)(params=params)
+    return load_trajectories(dynsys, dyn_sys_name, params, size, 0.5, 0.05, cache_dir=str(cache_dir), split=split, **kwargs)
+
+
+def test_hit_returns_the_stored_solve(tmp_path, monkeypatch):
+    xyz, times, control = load(tmp_path, chunk_size=5)
+    assert control is None and xyz.shape == (12, len(times), 3)
+
+    def solve(*args):
+        raise AssertionError('a cache hit must not solve')
+    monkeypatch.setattr(datasets, 'solve_trajectory_chunk', solve)
+    hit = load(tmp_path, chunk_size=5)
+    torch.testing.assert_close(hit[0], xyz, rtol=0, atol=0)
+    torch.testing.assert_close(hit[1], times, rtol=0, atol=0)
+
+
+def test_chunks_are_seeded_from_the_key(tmp_path):
+    xyz, times, _ = load(tmp_path, chunk_size=5)
+    spec = {'dyn_sys_name': 'Lorenz63', 'params': {}, 'size': 12, 'T': 0.5, 'dt': 0.05, 'test': False, 'seed': 0,
+            'split': 'train', 'chunk_size': 5}
+    key = trajectory_cache_key(spec)
+    assert os.listdir(tmp_path) == [key]
+    # the middle chunk, solved on its own
+    chunk = solve_trajectory_chunk('Lorenz63', {}, 5, 0.5, 0.05, False, int(key[:12], 16) + 1)
+    torch.testing.assert_close(xyz[5:10], torch.from_numpy(chunk[0]), rtol=0, atol=0)
+
+
+def test_data_does_not_depend_on_the_workers(tmp_path):
+    serial = load(tmp_path / 'serial', chunk_size=4)
+    parallel = load(tmp_path / 'parallel', chunk_size=4, num_workers=3)
+    torch.testing.assert_close(parallel[0], serial[0], rtol=0, atol=0)
+
+
+def test_global_rng_is_untouched(tmp_path):
+    state = torch.random.get_rng_state()
+    load(tmp_path)
+    assert torch.equal(torch.random.get_rng_state(), state)
+
+
+def test_splits_and_seeds_get_different_data(tmp_path):
+    train = load(tmp_path)[0]
+    assert not torch.equal(load(tmp_path, split='val')[0], train)
+    assert not torch.equal(load(tmp_path, seed=1)[0], train)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_control_is_cached(tmp_path):
+    xyz, times, control = load(tmp_path, dyn_sys_name='ControlledODE', size=4)
+    assert control.shape == (4, len(times), 1)
+    torch.testing.assert_close(load(tmp_path, dyn_sys_name='ControlledODE', size=4)[2], control, rtol=0, atol=0)
+
+
+def test_datasets_share_an_entry_across_input_inds(tmp_path):
+    kwargs = {'size': 6, 'T': 0.5, 'sample_rate': 0.05, 'cache_dir': str(tmp_path)}
+    first = DynamicsDataset(params={}, input_inds=[0], output_inds=[2], **kwargs)
+    second = DynamicsDataset(params={}, input_inds=[1], output_inds=[2], **kwargs)
+    assert len(os.listdir(tmp_path)) == 1
+    torch.testing.assert_close(first.y, second.y, rtol=0, atol=0)
+    assert not torch.equal(first.x, second.x)
+    # hits are memory-mapped copy-on-write, writes never reach the cache
+    second.x[0] = 0.
+    assert not torch.equal(DynamicsDataset(params={}, input_inds=[1], output_inds=[2], **kwargs).x[0], second.x[0])
@@ -1,4 +1,7 @@
+import os
 import numpy as np
+import torch
+import functools
 import itertools
 from numpy.fft import rfft2
 import itertools
@@ -40,15 +43,84 @@ class UnitGaussianNormalizer(object):
     Methods:
         encode(x): Normalize the input data using unit Gaussian normalization.
         decode(x): Denormalize the input data using unit Gaussian normalization.
+        update(x): Accumulate a chunk of the data into the statistics.
+        merge(other): Merge the statistics accumulated by another normalizer.
+        save(fname), load(fname): Persist the statistics.
     """
 
-    def __init__(self, x, eps=1e-5):
+    def __init__(self, x=None, eps=1e-5, mean=None, std=None):
         super(UnitGaussianNormalizer, self).__init__()
 
-        self.mean = np.mean(x, 0)
-        self.std = np.std(x, 0)
+        # statistics are either computed from x, given, or accumulated over chunks of the data with update and merge
+        self.mean = np.mean(x, 0) if x is not None else mean
+        self.std = np.std(x, 0) if x is not None else std
         self.eps = eps
 
+        # float64 moments of the chunks accumulated so far: count, mean and sum of squared deviations
+        self.count, self.moment_mean, self.m2 = 0, 0., 0.
+
+    def update(self, x):
+        """
+        Accumulate a chunk of the data into the statistics. After all chunks, mean and std are those of np.mean and
+        np.std along axis 0 of the concatenated chunks, up to rounding.
+
+        Args:
+            x (numpy.ndarray): A chunk of the data, samples along axis 0.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        chunk_mean = x.mean(0)
+        self.merge_moments(x.shape[0], chunk_mean, ((x - chunk_mean)**2).sum(0))
+
+    def merge(self, other):
+        """
+        Merge the statistics accumulated by another normalizer, e.g. over another part of the data in another process.
+
+        Args:
+            other (UnitGaussianNormalizer): The normalizer to merge.
+        """
+        self.merge_moments(other.count, other.moment_mean, other.m2)
+
+    def merge_moments(self, count, mean, m2):
+        # pairwise update of Chan et al., stable for chunks of any size
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.moment_mean
+        self.moment_mean = self.moment_mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.mean = self.moment_mean
+        self.std = np.sqrt(self.m2 / total)
+
+    def save(self, fname):
+        """
+        Save the statistics to an .npz file.
+
+        Args:
+            fname (str): The file, written to a temporary file first so that concurrent jobs never read a partial one.
+        """
+        tmp_fname = f'{fname}.tmp{os.getpid()}'
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, mean=self.mean, std=self.std, eps=self.eps,
+                     count=self.count, moment_mean=self.moment_mean, m2=self.m2)
+        os.replace(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Load statistics saved with save.
+
+        Args:
+            fname (str): The .npz file.
+
+        Returns:
+            UnitGaussianNormalizer: The normalizer.
+        """
+        with np.load(fname) as stats:
+            normalizer = cls(eps=float(stats['eps']), mean=stats['mean'], std=stats['std'])
+            normalizer.count, normalizer.moment_mean, normalizer.m2 = int(stats['count']), stats['moment_mean'], stats['m2']
+        return normalizer
+
     def encode(self, x):
         """
         Normalize the input data using unit Gaussian normalization.
@@ -74,6 +146,71 @@ class UnitGaussianNormalizer(object):
         return (x * (self.std + self.eps)) + self.mean
 
 
+class TorchUnitGaussianNormalizer(torch.nn.Module):
+    """
+    Unit Gaussian normalization as a torch module, applied on device by the LightningModules.
+
+    The statistics are float32 buffers, so they move with the model and are saved in its checkpoints. Checkpoints
+    saved before the statistics were buffers still load, strictly, and leave the normalizer unfitted.
+
+    Attributes:
+        mean (torch.Tensor): The mean values of the training data, shape (dim,).
+        std (torch.Tensor): The standard deviation values of the training data, shape (dim,).
+        eps (float): A small value added to the denominator to avoid division by zero.
+        fitted (bool): Whether the statistics were set or loaded, rather than the identity defaults.
+    """
+
+    def __init__(self, dim=1, eps=1e-5):
+        super(TorchUnitGaussianNormalizer, self).__init__()
+        self.eps = eps
+        self.register_buffer('mean', torch.zeros(dim))
+        self.register_buffer('std', torch.ones(dim))
+        self.fitted = False
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # older checkpoints have no statistics, they are kept as they are and refitted to the training data instead
+        if f'{prefix}mean' not in state_dict and f'{prefix}std' not in state_dict:
+            return
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        self.fitted = True
+
+    def set_stats(self, normalizer):
+        """
+        Copy the statistics of a UnitGaussianNormalizer.
+
+        Args:
+            normalizer (UnitGaussianNormalizer): The normalizer fitted to the training data.
+        """
+        self.mean.copy_(torch.as_tensor(np.asarray(normalizer.mean)).reshape(self.mean.shape))
+        self.std.copy_(torch.as_tensor(np.asarray(normalizer.std)).reshape(self.std.shape))
+        self.eps = normalizer.eps
+        self.fitted = True
+
+    def encode(self, x):
+        """
+        Normalize the input data using unit Gaussian normalization.
+
+        Args:
+            x (torch.Tensor): The input data to be normalized, channels last.
+
+        Returns:
+            torch.Tensor: The normalized data.
+        """
+        return (x - self.mean) / (self.std + self.eps)
+
+    def decode(self, x):
+        """
+        Denormalize the input data using unit Gaussian normalization.
+
+        Args:
+            x (torch.Tensor): The normalized data to be denormalized, channels last.
+
+        Returns:
+            torch.Tensor: The denormalized data.
+        """
+        return (x * (self.std + self.eps)) + self.mean
+
+
 def subsample_and_flatten(matrix, stride):
     """
     Subsamples a matrix and flattens it into a 1D array.
@@ -88,41 +225,50 @@ def subsample_and_flatten(matrix, stride):
     # Get the dimensions of the input matrix
     N, rows, cols = matrix.shape
 
-    # Create a list to store the indices of the elements to be extracted
-    indices = []
-
-    # Add indices for the first row (left to right)
-    indices.extend((0, j) for j in range(cols))
+    indices = subsample_indices(rows, cols, stride)
 
-    # Add indices for the last row (left to right)
-    if rows > 1:
-        indices.extend((rows - 1, j) for j in range(cols))
+    # Extract the elements from the matrix using the sorted indices, in a single gather
+    if matrix.flags['C_CONTIGUOUS']:
+        # a take along the flattened grid is faster than indexing rows and columns
+        result = np.take(matrix.reshape(N, -1), indices[:, 0] * cols + indices[:, 1], axis=1)
+    else:
+        result = matrix[:, indices[:, 0], indices[:, 1]]
 
-    # Add indices for the first column (top to bottom, excluding corners)
-    if rows > 2:
-        indices.extend((i, 0) for i in range(1, rows - 1))
+    return indices.astype('float32'), result.astype('float32')
 
-    # Add indices for the last column (top to bottom, excluding corners)
+@functools.lru_cache(maxsize=None)
+def subsample_indices(rows, cols, stride):
+    """
+    Returns the sorted (row, col) indices extracted by subsample_and_flatten from a grid of shape (rows, cols):
+    the boundary, and the interior elements based on the stride. The result is an integer array of shape
+    (n_indices, 2), computed once per (rows, cols, stride) and read-only.
+    """
+    # first and last row (left to right), then first and last column (top to bottom, excluding corners)
+    boundary_i = [np.zeros(cols, dtype=int)]
+    boundary_j = [np.arange(cols)]
+    if rows > 1:
+        boundary_i.append(np.full(cols, rows - 1))
+        boundary_j.append(np.arange(cols))
     if rows > 2:
-        indices.extend((i, cols - 1) for i in range(1, rows - 1))
-
-    # print(indices)
-    # Generate indices for the interior elements based on the stride
-    counter = 0
-    for i in range(1, rows - 1):
-        for j in range(1, cols - 1):
-            if counter % stride == 0:
-                indices.append((i, j))
-                counter = 0
-            counter += 1
-
-    # sort the indices
-    indices.sort(key=lambda x: (x[0], x[1]))
-
-    # Extract the elements from the matrix using the sorted indices
-    result = [matrix[:, i, j] for i, j in indices]
-
-    return np.array(indices).astype('float32'), np.array(result).T.astype('float32')
+        boundary_i += [np.arange(1, rows - 1), np.arange(1, rows - 1)]
+        boundary_j += [np.zeros(rows - 2, dtype=int), np.full(rows - 2, cols - 1)]
+
+    # interior elements are taken every period-th element in row-major order, where period is the first count at
+    # which the counter of the former loop wrapped (counter % stride == 0), which also covers non-integer strides
+    n_interior = max(rows - 2, 0) * max(cols - 2, 0)
+    period = next((c for c in range(1, n_interior + 1) if c % stride == 0), n_interior)
+    interior = np.arange(0, n_interior, max(period, 1))
+    interior_i = 1 + interior // max(cols - 2, 1)
+    interior_j = 1 + interior % max(cols - 2, 1)
+
+    i = np.concatenate(boundary_i + [interior_i])
+    j = np.concatenate(boundary_j + [interior_j])
+
+    # sort the indices by row, then column
+    order = np.lexsort((j, i))
+    indices = np.stack([i[order], j[order]], axis=1)
+    indices.flags.writeable = False
+    return indices
 
 def patch_coords(matrix):
     """